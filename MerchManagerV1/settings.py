@@ -211,10 +211,25 @@ app = Celery('MerchManagerV1')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
+# Order emails are not polled from here: the `ingest` process (the ingest_orders
+# command) holds an IMAP IDLE connection and ingests them as they arrive
 CELERY_BEAT_SCHEDULE = {
-    'run_my_task_within_specific_hours': {
-        'task': 'MerchManagerV1.tasks.my_task',
-        'schedule': crontab(minute='*/5', hour='5-14', day_of_week='*'),
+    # Picks up item catalog edits made outside the app (see operations.item_ordering)
+    'refresh_catalog_version': {
+        'task': 'operations.tasks.refresh_catalog_version_task',
+        'schedule': crontab(minute='*/10'),
+        'args': (),
+    },
+    # Sets match_key on transfers written by the transfer system, so verify_order finds them by equality
+    'key_new_transfers': {
+        'task': 'operations.tasks.key_new_transfers_task',
+        'schedule': crontab(minute='*/2'),
+        'args': (),
+    },
+    # Keeps open orders' pick sheets pre-rendered across location changes and ORDER_PDF_TTL expiry
+    'render_open_order_pdfs': {
+        'task': 'operations.tasks.render_open_order_pdfs_task',
+        'schedule': crontab(minute='*/5'),
         'args': (),
     },
 }
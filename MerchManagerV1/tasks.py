@@ -1,8 +1,8 @@
 from celery import shared_task
-from operations.Order_Backend import main
+from operations.Order_Backend import order_main
 
 
 @shared_task
 def my_task():
     print("Running email_parse_util")
-    main()
+    order_main()
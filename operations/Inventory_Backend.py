@@ -1,32 +1,107 @@
-import imaplib
 import email
 import os
+from concurrent.futures import ProcessPoolExecutor
+from email.parser import Parser
 from email.policy import default
 import fitz  # PyMuPDF
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import DuplicateKeyError
 import re
 
+from operations.indexes import create_collection_indexes
+from operations.imap_utils import IMAP_FETCH_CHUNK_SIZE, connect_imap, search_uids, fetch_messages, \
+    fetch_message_items, iter_body_parts, get_part_filename, decode_part, mark_seen
+from operations.inventory_series import ensure_inventory_series, record_inventory_levels
+from operations.inventory_snapshots import INVENTORY_FULL_DOCUMENTS, ensure_snapshot_indexes, \
+    record_inventory_snapshot, compact_inventory_documents, get_latest_snapshot_of, load_snapshot_items, index_items
+from operations.mongodb_utils import get_client
+from operations.order_pdfs import bump_data_version, queue_order_pdf_render
+from operations.raw_archive import INVENTORY_PDF, archive_raw, get_received_at
+
+# 'rfc822' downloads whole inventory emails; 'bodystructure' downloads only their PDF parts
+INVENTORY_FETCH_MODE = os.getenv('INVENTORY_FETCH_MODE', 'rfc822')
+INVENTORY_STRUCTURE_FIELDS = '(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (DATE)])'
+
+# Above 1, inventory attachments are parsed in a process pool of this many workers
+INVENTORY_PARSE_WORKERS = int(os.getenv('INVENTORY_PARSE_WORKERS', '1'))
+# Pages of one PDF handled per process pool task
+INVENTORY_PAGES_PER_TASK = int(os.getenv('INVENTORY_PAGES_PER_TASK', '10'))
+
+# 'python' computes OOS items and stats in this process; 'aggregate' runs them as server-side pipelines
+INVENTORY_STATS_MODE = os.getenv('INVENTORY_STATS_MODE', 'python')
+
+INVENTORY_ITEM_PATTERN = re.compile(r'^(\d+) - (\w[\w\s.-]+)')
+# Matched against the line after an item name for its "Case" or "Each" quantity
+INVENTORY_QUANTITY_PATTERN = re.compile(r'^\s*(Case|Each)\s+(\d+)')
+
 
 def fetch_emails_from_inventory_folder(email_address, password):
-    mail = imaplib.IMAP4_SSL('imap.gmail.com')
-    mail.login(email_address, password)
-    mail.select('"[Gmail]/All Mail"')  # Adjust as needed for your "Inventory" folder
+    """
+    Yields the raw unread emails from the inventory folder.
+
+    Messages are requested in chunks of IMAP_FETCH_CHUNK_SIZE per FETCH and
+    handed to the caller as they arrive; RFC822 still marks them as seen.
+    """
+    mail = connect_imap(email_address, password)
+    try:
+        mail.select('"[Gmail]/All Mail"')  # Adjust as needed for your "Inventory" folder
+
+        uids = search_uids(mail, 'UNSEEN')  # Or use 'ALL' for all emails
+        for _, raw_email in fetch_messages(mail, uids, '(RFC822)'):
+            yield raw_email
+    finally:
+        mail.logout()
 
-    result, data = mail.search(None, 'UNSEEN')  # Or use 'ALL' for all emails
-    emails = []
-    if result == 'OK':
-        for num in data[0].split():
-            result, email_data = mail.fetch(num, '(RFC822)')
-            if result == 'OK':
-                emails.append(email_data[0][1])
 
-    mail.logout()
-    return emails
+def fetch_pdf_parts_from_inventory_folder(email_address, password):
+    """
+    Yields (received_at, filename, content) for the PDFs attached to the unread inventory emails.
+
+    Reads each message's BODYSTRUCTURE and Date header first, then downloads only
+    the application/pdf parts with BODY.PEEK[<part>], leaving images and other
+    parts on the server. Messages are marked seen once their PDFs have been
+    read, as the full RFC822 fetch does.
+    """
+    mail = connect_imap(email_address, password)
+    try:
+        mail.select('"[Gmail]/All Mail"')  # Adjust as needed for your "Inventory" folder
+
+        uids = search_uids(mail, 'UNSEEN')
+        for start in range(0, len(uids), IMAP_FETCH_CHUNK_SIZE):
+            chunk = uids[start:start + IMAP_FETCH_CHUNK_SIZE]
+            pdf_parts = []  # (uid, part number, filename, encoding)
+            received_at = {}
+            for uid, items in fetch_message_items(mail, chunk, INVENTORY_STRUCTURE_FIELDS):
+                headers = next((value for name, value in items.items() if name.startswith('BODY[')), '')
+                received_at[uid] = get_received_at(Parser(policy=default).parsestr(headers or '', headersonly=True))
+                for part_number, part in iter_body_parts(items['BODYSTRUCTURE']):
+                    if f'{part[0]}/{part[1]}'.lower() == 'application/pdf':
+                        filename = get_part_filename(part)
+                        if filename:
+                            pdf_parts.append((uid, part_number, filename, part[5]))
+
+            # One FETCH per distinct part number, covering every message with a PDF there
+            contents = {}
+            for part_number in sorted({part_number for _, part_number, _, _ in pdf_parts}):
+                part_uids = [uid for uid, number, _, _ in pdf_parts if number == part_number]
+                for uid, payload in fetch_messages(mail, part_uids, f'(BODY.PEEK[{part_number}])'):
+                    contents[uid, part_number] = payload
+
+            for uid, part_number, filename, encoding in pdf_parts:
+                if (uid, part_number) in contents:
+                    yield received_at[uid], filename, decode_part(contents[uid, part_number], encoding)
+            mark_seen(mail, chunk)
+    finally:
+        mail.logout()
 
 
 def extract_pdf_attachments(raw_email):
-    email_message = email.message_from_bytes(raw_email, policy=default)
+    # Parse the email, unless the caller already handed us a parsed message
+    if isinstance(raw_email, (bytes, bytearray)):
+        email_message = email.message_from_bytes(raw_email, policy=default)
+    else:
+        email_message = raw_email
     attachments = []
 
     for part in email_message.walk():
@@ -40,31 +115,67 @@ def extract_pdf_attachments(raw_email):
 
 
 def parse_inventory_pdf(pdf_bytes):
-    inventory_data = {'items': []}
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    text = ""
-    for page in doc:
-        text += page.get_text("text")
+    """
+    Parses an inventory count PDF page by page.
 
-    lines = text.split('\n')
-    item_pattern = re.compile(r'^(\d+) - (\w[\w\s.-]+)')
-    # Adjusted to consider the next line after item name for "Case" or "Each"
-    quantity_pattern = re.compile(r'^\s*(Case|Each)\s+(\d+)')
+    Only one page of text is held at a time and the document is closed as soon
+    as the last page has been read.
 
-    current_item = {}
-    skip_next_line = False  # Flag to skip processing for quantity lines
+    :param pdf_bytes: The PDF attachment content.
+    :return: Dict with the parsed 'items'.
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return {'items': parse_inventory_lines(iter_pdf_lines(doc))}
 
-    for i, line in enumerate(lines):
-        if skip_next_line:
-            skip_next_line = False
-            continue
 
-        item_match = item_pattern.match(line)
+def iter_pdf_lines(doc):
+    """
+    Yields the text lines of a PDF document, page by page.
+
+    A page whose text does not end in a newline continues its last line on the
+    next page, exactly as if the page texts had been concatenated first.
+    """
+    return iter_text_lines(page.get_text("text") for page in doc)
+
+
+def iter_text_lines(page_texts):
+    partial_line = ''
+    for text in page_texts:
+        lines = (partial_line + text).split('\n')
+        partial_line = lines.pop()
+        yield from lines
+    yield partial_line
+
+
+def parse_inventory_lines(lines):
+    """
+    Turns inventory PDF lines into items.
+
+    An item line ("123 - Name") may be followed by a quantity line; "Case n"
+    sets its Cases, while "Each n" drops the item. The quantity line is consumed
+    either way, whichever page it falls on.
+    """
+    items = []
+    current_item = {}
+    awaiting_quantity = False  # The previous line started an item, so this one may hold its quantity
+
+    for line in lines:
+        if awaiting_quantity:
+            awaiting_quantity = False
+            quantity_match = INVENTORY_QUANTITY_PATTERN.match(line)
+            if quantity_match:
+                quantity_type, quantity = quantity_match.groups()
+                if quantity_type == "Case":
+                    current_item['Cases'] = quantity
+                elif quantity_type == "Each":
+                    current_item.clear()
+                continue
+
+        item_match = INVENTORY_ITEM_PATTERN.match(line)
         if item_match:
             # Finalize and save the previous item
             if current_item:
-                inventory_data['items'].append(current_item)
-                current_item = {}
+                items.append(current_item)
 
             # Initialize new item
             current_item = {
@@ -73,24 +184,13 @@ def parse_inventory_pdf(pdf_bytes):
                 'Cases': None,
                 'Eaches': None
             }
-
-            # Check if next line contains "Case" or "Each" quantity
-            if i + 1 < len(lines):
-                next_line = lines[i + 1]
-                quantity_match = quantity_pattern.match(next_line)
-                if quantity_match:
-                    quantity_type, quantity = quantity_match.groups()
-                    if quantity_type == "Case":
-                        current_item['Cases'] = quantity
-                    elif quantity_type == "Each":
-                        current_item.clear()
-                    skip_next_line = True  # Skip the next line as it has been processed
+            awaiting_quantity = True
 
     # Add the last item if it exists
-    if current_item.get('ItemNumber'):  # Corrected from 'Item number' to 'ItemNumber'
-        inventory_data['items'].append(current_item)
+    if current_item.get('ItemNumber'):
+        items.append(current_item)
 
-    return inventory_data
+    return items
 
 
 # Sample usage with the provided PDF content as bytes
@@ -98,34 +198,176 @@ def parse_inventory_pdf(pdf_bytes):
 # inventory_data = parse_inventory_pdf(pdf_bytes)
 
 
-def save_inventory_to_mongodb(inventory_data, client):
-    db = client['mydatabase']
+def save_inventory_to_mongodb(inventory_data, client, inventory_id=None, taken_at=None, db_name='mydatabase'):
+    """
+    Inserts a parsed inventory and records it in the snapshots and the level series.
+
+    :param inventory_id: _id to insert under; replay_archive dates it to when the PDF arrived.
+    :param taken_at: When the count was taken, as naive UTC; defaults to now.
+    :return: The _id of the inserted document, or None if nothing was inserted.
+    """
+    db = client[db_name]
     collection = db['inventory']
 
     if inventory_data and inventory_data['items']:  # Ensure there are items to save
-        result = collection.insert_one(inventory_data)
+        if inventory_id is not None:
+            inventory_data['_id'] = inventory_id
+        try:
+            result = collection.insert_one(inventory_data)
+        except DuplicateKeyError:
+            print(f"Inventory PDF {inventory_data.get('pdf_sha256')} was already saved, skipping.")
+            return
         print(f"Inventory data inserted with record id: {result.inserted_id}")
+        record_inventory_snapshot(client, inventory_data, result.inserted_id, taken_at, db_name)
+        record_inventory_levels(client, inventory_data, result.inserted_id, taken_at, db_name)
+        return result.inserted_id
     else:
         print("No inventory items to save.")
 
 
+def replace_inventory_items(client, inventory_data, db_name='mydatabase'):
+    """
+    Stores re-parsed items for an inventory PDF that is already saved (replay_archive).
+
+    If they differ from its latest snapshot, a new snapshot with the original
+    taken_at is recorded, which supersedes the old one in get_inventory_as_of.
+    The document's own items are only rewritten if it was not compacted.
+
+    :return: True if the items changed.
+    """
+    collection = client[db_name]['inventory']
+    inventory = collection.find_one({'pdf_sha256': inventory_data['pdf_sha256']}, {'_id': 1, 'compacted': 1})
+    if inventory is None:
+        return False
+
+    snapshot = get_latest_snapshot_of(client, inventory['_id'], db_name)
+    if snapshot and load_snapshot_items(client, snapshot, db_name) == index_items(inventory_data['items']):
+        return False
+
+    if not inventory.get('compacted'):
+        collection.update_one({'_id': inventory['_id']}, {'$set': {'items': inventory_data['items']}})
+    taken_at = snapshot['taken_at'] if snapshot else inventory['_id'].generation_time.replace(tzinfo=None)
+    record_inventory_snapshot(client, inventory_data, inventory['_id'], taken_at, db_name)
+    return True
+
+
+def ensure_inventory_indexes(client, db_name='mydatabase', inventory_collection='inventory'):
+    """
+    Creates the unique pdf_sha256 index so each inventory PDF is stored once.
+
+    Inventories saved before PDFs were hashed have no pdf_sha256, so the index
+    only covers documents where it is a string.
+    """
+    create_collection_indexes(client, 'inventory', db_name, inventory_collection)
 
 
 def process_inventory_emails(email_address, password, client):
-    emails = fetch_emails_from_inventory_folder(email_address, password)
+    attachments = skip_parsed_pdfs(iter_inventory_attachments(email_address, password, client), client)
+
+    if INVENTORY_PARSE_WORKERS > 1:
+        # Month-end batches: parse every attachment at once across the process pool
+        attachments = list(attachments)
+        parsed = zip([pdf_sha256 for pdf_sha256, _ in attachments],
+                     parse_inventory_pdfs_parallel([content for _, content in attachments]))
+    else:
+        parsed = ((pdf_sha256, parse_inventory_pdf(content)) for pdf_sha256, content in attachments)
+
+    for pdf_sha256, inventory_data in parsed:
+        if inventory_data:
+            inventory_data['pdf_sha256'] = pdf_sha256
+            save_inventory_to_mongodb(inventory_data, client)
+
+
+def iter_inventory_attachments(email_address, password, client):
+    """
+    Yields (pdf_sha256, content) for every PDF attached to the new inventory emails, archiving each one.
+    """
+    if INVENTORY_FETCH_MODE == 'bodystructure':
+        pdfs = fetch_pdf_parts_from_inventory_folder(email_address, password)
+    else:
+        pdfs = iter_pdf_attachments(fetch_emails_from_inventory_folder(email_address, password))
+
+    for received_at, filename, content in pdfs:
+        # Keep the original so the PDF can be re-parsed later (see the replay_archive command)
+        yield archive_raw(client, content, INVENTORY_PDF, received_at, filename=filename), content
+
+
+def iter_pdf_attachments(raw_emails):
+    for raw_email in raw_emails:
+        email_message = email.message_from_bytes(raw_email, policy=default)
+        received_at = get_received_at(email_message)
+        for filename, content in extract_pdf_attachments(email_message):
+            yield received_at, filename, content
 
-    for raw_email in emails:
-        attachments = extract_pdf_attachments(raw_email)
-        # Inside process_inventory_emails, when calling parse_inventory_pdf
-        for filename, content in attachments:
-            inventory_data = parse_inventory_pdf(content)  # content is already in bytes
-            if inventory_data:
-                save_inventory_to_mongodb(inventory_data, client)
 
+def skip_parsed_pdfs(attachments, client, db_name='mydatabase', inventory_collection='inventory'):
+    """
+    Drops attachments whose PDF was already parsed and saved, before any fitz work is done.
 
-def identify_and_upload_oos_items(client):
+    Forwarded and re-sent counts carry byte-identical PDFs; the inventory saved
+    the first time stays the one in use instead of a copy becoming the latest.
+    """
+    inventory_col = client[db_name][inventory_collection]
+    seen = set()
+    for pdf_sha256, content in attachments:
+        if pdf_sha256 in seen or inventory_col.find_one({'pdf_sha256': pdf_sha256}, {'_id': 1}):
+            print(f"Inventory PDF {pdf_sha256} was already parsed, skipping.")
+            continue
+        seen.add(pdf_sha256)
+        yield pdf_sha256, content
+
+
+def parse_inventory_pdfs_parallel(pdfs, workers=None, pages_per_task=None):
+    """
+    Parses several inventory PDFs across a process pool.
+
+    Text extraction is split into tasks of at most pages_per_task pages, so one
+    large count PDF is spread over several workers too. Each PDF's page texts
+    are then put back in page order and run through parse_inventory_lines here,
+    which keeps the result identical to parse_inventory_pdf.
+
+    :param pdfs: List of PDF contents.
+    :return: List of inventory data dicts, in the same order as pdfs.
+    """
+    workers = workers or INVENTORY_PARSE_WORKERS
+    pages_per_task = pages_per_task or INVENTORY_PAGES_PER_TASK
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for pdf_bytes in pdfs:
+            with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+                page_count = doc.page_count
+            futures.append([executor.submit(extract_page_texts, pdf_bytes, start, min(start + pages_per_task,
+                                                                                     page_count))
+                            for start in range(0, page_count, pages_per_task)])
+
+        results = []
+        for page_range_futures in futures:
+            page_texts = (text for future in page_range_futures for text in future.result())
+            results.append({'items': parse_inventory_lines(iter_text_lines(page_texts))})
+    return results
+
+
+def extract_page_texts(pdf_bytes, start, stop):
+    """
+    Process pool worker: returns the text of pages [start, stop) of a PDF.
+    """
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return [doc[page_number].get_text("text") for page_number in range(start, stop)]
+
+
+def identify_and_upload_oos_items(client, db_name='mydatabase'):
+    """
+    Brings oos_items in line with the latest inventory.
+
+    The out-of-stock set is diffed against what oos_items already holds and
+    the difference is applied with one bulk_write, so readers always see a
+    complete set and unchanged items are not rewritten.
+
+    :return: Dict with the added, updated and removed counts, or None on failure.
+    """
     try:
-        db = client['mydatabase']
+        db = client[db_name]
 
         # Collections
         inventory_collection = db['inventory']
@@ -144,35 +386,66 @@ def identify_and_upload_oos_items(client):
         # Fetch all items that are considered active or relevant from items collection
         all_items = list(items_collection.find({}, {'ItemNumber': 1, 'ItemDescription': 1, 'Grand Total': 1}))
 
-        # Delete all existing documents in oos_items_collection before uploading new ones
-        oos_items_collection.delete_many({})
-
-        # Identify OOS items
-        oos_items = []
+        # Identify OOS items, keyed by their normalized item number
+        oos_items = {}
         for item in all_items:
             if item['ItemNumber'] not in inventory_item_numbers:
-                # Adding only relevant fields to OOS items list
                 item_number = int(float(item['ItemNumber']))  # Convert to float first, then to int to handle .0
-                oos_item = {
-                    'ItemNumber': str(item_number),  # Convert integer back to string
-                    'ItemDescription': item.get('ItemDescription', ''),
-                }
-                oos_items.append(oos_item)
-
-        # Upload OOS items to MongoDB, if any
-        if oos_items:
-            result = oos_items_collection.insert_many(oos_items)
-            print(f"Uploaded {len(result.inserted_ids)} OOS items to MongoDB.")
-        else:
-            print("No OOS items to upload.")
+                oos_items[str(item_number)] = item.get('ItemDescription', '')
+
+        changes = diff_oos_items(oos_items, oos_items_collection.find({}, {'ItemNumber': 1, 'ItemDescription': 1}))
+        operations = changes.pop('operations')
+        if operations:
+            oos_items_collection.bulk_write(operations, ordered=False)
+        print(f"OOS items: {changes['added']} added, {changes['updated']} updated, {changes['removed']} removed.")
+        return changes
 
     except Exception as e:
         print(f"An error occurred: {e}")
 
 
-def generate_and_save_inventory_stats(client):
+def diff_oos_items(oos_items, current_documents):
+    """
+    Works out the writes that turn the current oos_items documents into the wanted set.
+
+    :param oos_items: Dict of ItemNumber -> ItemDescription that should be out of stock.
+    :param current_documents: The documents oos_items holds now.
+    :return: Dict with the bulk_write operations and the added, updated and removed counts.
+    """
+    operations = []
+    changes = {'added': 0, 'updated': 0, 'removed': 0}
+
+    current = {}
+    removed = set()
+    for document in current_documents:
+        item_number = document.get('ItemNumber')
+        if item_number not in oos_items:
+            operations.append(DeleteOne({'_id': document['_id']}))
+            removed.add(item_number)
+        elif item_number in current:
+            # Duplicate left by the old delete-and-insert runs
+            operations.append(DeleteOne({'_id': document['_id']}))
+        else:
+            current[item_number] = document
+    changes['removed'] = len(removed)
+
+    for item_number, item_description in oos_items.items():
+        if item_number not in current:
+            operations.append(UpdateOne({'ItemNumber': item_number},
+                                        {'$set': {'ItemDescription': item_description}}, upsert=True))
+            changes['added'] += 1
+        elif current[item_number].get('ItemDescription') != item_description:
+            operations.append(UpdateOne({'_id': current[item_number]['_id']},
+                                        {'$set': {'ItemDescription': item_description}}))
+            changes['updated'] += 1
+
+    changes['operations'] = operations
+    return changes
+
+
+def generate_and_save_inventory_stats(client, db_name='mydatabase'):
     try:
-        db = client['mydatabase']
+        db = client[db_name]
 
         inventory_collection = db['inventory']
         oos_items_collection = db['oos_items']
@@ -205,15 +478,145 @@ def generate_and_save_inventory_stats(client):
         print(f"An error occurred: {e}")
 
 
+def ensure_oos_indexes(client, db_name='mydatabase', oos_collection='oos_items'):
+    """
+    Creates the unique ItemNumber index that $merge into oos_items matches on.
+
+    Duplicates left by the old delete-and-insert runs are removed first.
+    """
+    oos_items_collection = client[db_name][oos_collection]
+    duplicates = oos_items_collection.aggregate([
+        {'$group': {'_id': '$ItemNumber', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ])
+    extra_ids = [document_id for duplicate in duplicates for document_id in duplicate['ids'][1:]]
+    if extra_ids:
+        oos_items_collection.delete_many({'_id': {'$in': extra_ids}})
+    create_collection_indexes(client, 'oos_items', db_name, oos_collection)
+
+
+def identify_and_upload_oos_items_aggregate(client, db_name='mydatabase'):
+    """
+    Server-side version of identify_and_upload_oos_items.
+
+    One aggregation anti-joins items against the latest inventory and merges
+    the OOS items into oos_items, stamping each with the inventory it came from.
+    Items stamped with an older inventory are back in stock and get deleted.
+    Only the counts come back over the network.
+
+    The $lookup gathers every OOS item into the single document's `as` array,
+    so the pipeline relies on the server coalescing the $unwind that follows
+    into the $lookup. Without that, all OOS items would have to fit in one
+    16MB document.
+
+    :return: Dict with the removed count, or None on failure.
+    """
+    try:
+        db = client[db_name]
+
+        latest_inventory = db['inventory'].find_one(sort=[("_id", -1)], projection={'_id': 1})
+        if not latest_inventory:
+            print("No inventory found")
+            return
+        inventory_id = latest_inventory['_id']
+
+        db['inventory'].aggregate([
+            {'$match': {'_id': inventory_id}},
+            {'$project': {'item_numbers': '$items.ItemNumber'}},
+            {'$lookup': {
+                'from': 'items',
+                'let': {'item_numbers': '$item_numbers'},
+                'pipeline': [
+                    {'$match': {'$expr': {'$not': {'$in': ['$ItemNumber', '$$item_numbers']}}}},
+                    # Same normalization as the Python path: "123.0" -> "123"
+                    {'$project': {
+                        '_id': 0,
+                        'ItemNumber': {'$toString': {'$toLong': {'$toDouble': '$ItemNumber'}}},
+                        'ItemDescription': {'$ifNull': ['$ItemDescription', '']},
+                    }},
+                ],
+                'as': 'oos_items',
+            }},
+            # Must directly follow the $lookup so the two are coalesced; see the docstring
+            {'$unwind': '$oos_items'},
+            {'$replaceRoot': {'newRoot': '$oos_items'}},
+            {'$set': {'inventory_id': inventory_id}},
+            {'$merge': {'into': 'oos_items', 'on': 'ItemNumber', 'whenMatched': 'merge', 'whenNotMatched': 'insert'}},
+        ])
+        result = db['oos_items'].delete_many({'inventory_id': {'$ne': inventory_id}})
+
+        print(f"OOS items merged for inventory {inventory_id}, {result.deleted_count} removed.")
+        return {'removed': result.deleted_count}
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
+def generate_and_save_inventory_stats_aggregate(client, db_name='mydatabase'):
+    """
+    Server-side version of generate_and_save_inventory_stats.
+
+    Sums the latest inventory's cases and counts oos_items in one aggregation
+    that merges the stats document straight into inventory_stats.
+    """
+    try:
+        db = client[db_name]
+
+        latest_inventory = db['inventory'].find_one(sort=[("_id", -1)], projection={'_id': 1})
+        if not latest_inventory:
+            print("No inventory found")
+            return
+
+        db['inventory'].aggregate([
+            {'$match': {'_id': latest_inventory['_id']}},
+            {'$lookup': {'from': 'oos_items', 'pipeline': [{'$count': 'count'}], 'as': 'oos_count'}},
+            {'$project': {
+                '_id': 0,
+                # Cases that are not whole numbers count as zero, as in the Python path
+                'total_inventory': {'$sum': {'$map': {
+                    'input': '$items',
+                    'in': {'$cond': [
+                        {'$regexMatch': {'input': {'$ifNull': [{'$toString': '$$this.Cases'}, '']},
+                                         'regex': '^[0-9]+$'}},
+                        {'$toInt': '$$this.Cases'},
+                        0,
+                    ]},
+                }}},
+                'num_oos_items': {'$ifNull': [{'$arrayElemAt': ['$oos_count.count', 0]}, 0]},
+            }},
+            {'$merge': {'into': 'inventory_stats', 'whenNotMatched': 'insert'}},
+        ])
+        print("Inventory statistics saved.")
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
 def inventory_main():
     load_dotenv()  # This method will load variables from a .env file
 
     email_address = os.getenv('EMAIL_ADDRESS')
     password = os.getenv('EMAIL_PASSWORD')
-    db_uri = os.getenv('DB_URI')
-    client = MongoClient(db_uri)
+    client = get_client()
 
+    ensure_inventory_indexes(client)
+    ensure_snapshot_indexes(client)
+    ensure_inventory_series(client)
     process_inventory_emails(email_address, password, client)
-    identify_and_upload_oos_items(client)
-    generate_and_save_inventory_stats(client)
-    client.close()
+    # The new inventories are snapshotted, so older full documents only take up space
+    compacted = compact_inventory_documents(client, INVENTORY_FULL_DOCUMENTS)
+    print(f"Compacted {compacted} inventory documents.")
+    if INVENTORY_STATS_MODE == 'aggregate':
+        ensure_oos_indexes(client)
+        identify_and_upload_oos_items_aggregate(client)
+        generate_and_save_inventory_stats_aggregate(client)
+        oos_changed = True  # The merge does not report what it added
+    else:
+        changes = identify_and_upload_oos_items(client)
+        generate_and_save_inventory_stats(client)
+        oos_changed = bool(changes and any(changes.values()))
+
+    if oos_changed:
+        # The OOS marks on every pick sheet may have changed
+        bump_data_version(client, 'oos_version')
+        queue_order_pdf_render()
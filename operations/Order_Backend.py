@@ -1,8 +1,11 @@
+import asyncio
+import hashlib
 import os
-import email as email_lib
+import time
 
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson.objectid import ObjectId
 import imaplib
 from email import policy
 from email.parser import BytesParser
@@ -10,6 +13,22 @@ from bs4 import BeautifulSoup
 import re
 from datetime import datetime
 
+from operations.html_tables import extract_table_rows
+from operations.indexes import create_collection_indexes
+from operations.transfers import transfer_match_key
+from operations.item_ordering import get_item_ordering, reorder_items
+from operations.mongodb_utils import get_client
+from operations.order_pdfs import queue_order_pdf_render
+from operations.raw_archive import ORDER_EMAIL, archive_raw, get_received_at
+from operations.imap_utils import connect_imap, select_mailbox, search_uids, search_uids_after, fetch_messages, \
+    close_imap, idle_wait
+
+ORDER_SUBJECT_MARKER = 'Route Order for'
+ORDER_HEADER_FIELDS = '(BODY.PEEK[HEADER.FIELDS (SUBJECT MESSAGE-ID)])'
+DUPLICATE_KEY_ERROR = 11000
+
+# 'stream' walks the HTML once without building a tree; 'bs4' uses the original BeautifulSoup extractor
+ORDER_HTML_EXTRACTOR = os.getenv('ORDER_HTML_EXTRACTOR', 'stream')
 
 
 def fetch_last_email_content(email_address, password):
@@ -70,15 +89,21 @@ def handle_forwarded_emails(text_content):
 
 
 def parse_email_content(email_content):
-    # Parse the email content
-    msg = BytesParser(policy=policy.default).parsebytes(email_content)
+    # Parse the email content, unless the caller already handed us a parsed message
+    if isinstance(email_content, (bytes, bytearray)):
+        msg = BytesParser(policy=policy.default).parsebytes(email_content)
+    else:
+        msg = email_content
 
     # Prepare extracted data dictionary
     extracted_data = {
         'route_name': None,
         'route_number': None,
         'pick_up_date': None,
+        # True when no pick-up date could be read and the parse time stands in for it
+        'pick_up_date_estimated': False,
         'total_cases': None,
+        'message_id': get_message_key(msg, email_content),
         'items': []
     }
 
@@ -122,8 +147,10 @@ def parse_email_content(email_content):
         except ValueError as e:
             print(f"Error parsing pick-up date: {date_str} - {e}")
             extracted_data['pick_up_date'] = datetime.now()
+            extracted_data['pick_up_date_estimated'] = True
     else:
         extracted_data['pick_up_date'] = datetime.now()
+        extracted_data['pick_up_date_estimated'] = True
 
     # Further processing for HTML part (if necessary)
     if 'text/html' in email_str:
@@ -134,7 +161,34 @@ def parse_email_content(email_content):
     # Function to extract details from text content
 
 
+def get_message_key(msg, email_content=None):
+    """
+    Returns the key identifying the email an order came from.
+
+    This is the Message-ID header, or a SHA-256 of the raw message when the
+    header is missing. It is stored on the order and backed by a unique index
+    so re-ingesting the same email is a no-op.
+    """
+    message_id = str(msg['Message-ID'] or '').strip()
+    if message_id:
+        return message_id
+
+    raw_email = email_content if isinstance(email_content, (bytes, bytearray)) else msg.as_bytes()
+    return 'sha256:' + hashlib.sha256(raw_email).hexdigest()
+
+
 def extract_table_from_html(html_body, extracted_data):
+    if ORDER_HTML_EXTRACTOR == 'bs4':
+        return extract_table_from_html_bs4(html_body, extracted_data)
+
+    for cols in extract_table_rows(html_body):
+        if len(cols) >= 3:  # Checking if there are at least three columns
+            append_order_item(cols[0], cols[1], cols[2], extracted_data)
+
+    return extracted_data
+
+
+def extract_table_from_html_bs4(html_body, extracted_data):
     soup = BeautifulSoup(html_body, 'html.parser')
     tables = soup.find_all('table')  # Assuming the relevant items are in one of the tables
     for table in tables:
@@ -142,61 +196,39 @@ def extract_table_from_html(html_body, extracted_data):
         for row in rows[1:]:  # Assuming the first row contains header and skipping it
             cols = row.find_all('td')
             if len(cols) >= 3:  # Checking if there are at least three columns
-                item_number = cols[0].get_text(strip=True)
-                item_description = cols[1].get_text(strip=True)
-                quantity = cols[2].get_text(strip=True)
-
-                # Check for a valid quantity; it must be a digit
-                if item_number and item_description and quantity.isdigit():
-                    item_dict = {
-                        'ItemNumber': item_number,
-                        'ItemDescription': item_description,
-                        'Quantity': int(quantity)
-                    }
-                    extracted_data['items'].append(item_dict)
+                append_order_item(cols[0].get_text(strip=True), cols[1].get_text(strip=True),
+                                  cols[2].get_text(strip=True), extracted_data)
 
     # Ensuring the dictionary is returned if used independently from the main parse function
     return extracted_data
 
 
+def append_order_item(item_number, item_description, quantity, extracted_data):
+    # Check for a valid quantity; it must be a digit
+    if item_number and item_description and quantity.isdigit():
+        item_dict = {
+            'ItemNumber': item_number,
+            'ItemDescription': item_description,
+            'Quantity': int(quantity)
+        }
+        extracted_data['items'].append(item_dict)
+
+
 # Example usage
 # raw_email_content = fetch_last_email_content('your_email@gmail.com', 'your_password')
 # parsed_data = parse_email(raw_email_content)
 
-def fetch_item_ordering(client, db_name='mydatabase', collection_name='items'):
-    db = client[db_name]
-    collection = db[collection_name]
-    items_ordering = {}
-    try:
-        cursor = collection.find({})
-        for item in cursor:
-            item_number = str(item.get('ItemNumber'))
-            order = item.get('Orderby', float('inf'))  # Use a large number for items without an ordering index
-            items_ordering[item_number] = order
-    except Exception as e:
-        print(f"Failed to fetch item ordering: {e}")
-    return items_ordering
-
-
-def reorder_items(items, items_ordering):
-    # Sort items based on the order provided in items_ordering
-    items.sort(key=lambda x: items_ordering.get(x['ItemNumber'], float('inf')))
-    return items
-
-
-def insert_order_into_mongodb(extracted_data, client, db_name='mydatabase', orders_collection='orders'):
+def build_order_document(extracted_data):
     """
-    Inserts the order details into a MongoDB collection.
+    Builds the order document stored in MongoDB from parsed email data.
 
-    :param extracted_data: The data to be inserted, including the order details.
-    :param client: MongoDB client instance.
-    :param db_name: The name of the database.
-    :param orders_collection: The name of the collection for orders.
+    :param extracted_data: The parsed order details.
+    :return: The order document, or None if the order has no items.
     """
     # Check if the necessary data is available
     if not extracted_data['items']:
         print("Missing items in order details.")
-        return
+        return None
 
     if not extracted_data.get('pick_up_date'):
         try:
@@ -210,7 +242,13 @@ def insert_order_into_mongodb(extracted_data, client, db_name='mydatabase', orde
     total_cases = sum(item.get('Quantity', 0) for item in extracted_data.get('items', []))
     order_submitted = datetime.today()
 
-    order_document = {
+    # Generate the _id locally so transfer_ID (the last 4 characters of it) is known before the write
+    order_id = ObjectId()
+
+    return {
+        '_id': order_id,
+        'transfer_id': str(order_id)[-4:],
+        'match_key': transfer_match_key(order_id),
         'route_name': extracted_data.get('route_name'),
         'route': extracted_data.get('route_number'),
         'order_submitted': order_submitted,
@@ -219,28 +257,98 @@ def insert_order_into_mongodb(extracted_data, client, db_name='mydatabase', orde
         'total_cases': total_cases,
         'items': extracted_data['items'],  # Assuming items is a list of dictionaries
         'status': "Pending",
+        'message_id': extracted_data.get('message_id'),
     }
 
+
+def insert_order_into_mongodb(extracted_data, client, db_name='mydatabase', orders_collection='orders'):
+    """
+    Inserts the order details into a MongoDB collection.
+
+    :param extracted_data: The data to be inserted, including the order details.
+    :param client: MongoDB client instance.
+    :param db_name: The name of the database.
+    :param orders_collection: The name of the collection for orders.
+    """
+    order_document = build_order_document(extracted_data)
+    if order_document is None:
+        return
+
     # Select the database and collection
     db = client[db_name]
     orders_col = db[orders_collection]
 
-    # Insert the document into the orders collection
-    result = orders_col.insert_one(order_document)
-    print(f"Order data inserted with record id: {result.inserted_id}")
+    # Insert the document into the orders collection, transfer_id included
+    try:
+        result = orders_col.insert_one(order_document)
+    except DuplicateKeyError:
+        print(f"Order from email {order_document['message_id']} was already ingested, skipping.")
+        return
+    print(f"Order data inserted with record id: {result.inserted_id}, transfer_id: {order_document['transfer_id']}")
+
+
+def insert_orders_into_mongodb(order_documents, client, db_name='mydatabase', orders_collection='orders'):
+    """
+    Inserts a batch of order documents with one unordered insert_many.
+
+    A failing document does not stop the rest of the batch; each failure is
+    reported and returned to the caller. Orders whose email was already
+    ingested are rejected by the unique message_id index and silently skipped.
+
+    :param order_documents: Documents built by build_order_document.
+    :param client: MongoDB client instance.
+    :param db_name: The name of the database.
+    :param orders_collection: The name of the collection for orders.
+    :return: List of (order_document, error message) tuples for the documents that were not inserted.
+    """
+    if not order_documents:
+        return []
+
+    db = client[db_name]
+    orders_col = db[orders_collection]
+
+    try:
+        result = orders_col.insert_many(order_documents, ordered=False)
+        inserted_count = len(result.inserted_ids)
+        failures = []
+    except BulkWriteError as e:
+        inserted_count = e.details.get('nInserted', 0)
+        failures = collect_insert_failures(e, order_documents)
+
+    print(f"Inserted {inserted_count} of {len(order_documents)} orders.")
+    return failures
 
-    # Generate transfer_ID (e.g., using the last 4 characters of the MongoDB _id)
-    transfer_id = str(result.inserted_id)[-4:]
 
-    # Update the document with the transfer_ID
-    orders_col.update_one({'_id': result.inserted_id}, {'$set': {'transfer_id': transfer_id}})
+def collect_insert_failures(error, order_documents):
+    """
+    Maps the writeErrors of an unordered insert_many back to the documents that failed.
 
-    print(f"Order updated with transfer_id: {transfer_id}")
+    Duplicate key errors mean another worker or an earlier run already stored
+    the order; they are not failures.
+    """
+    failures = []
+    for write_error in error.details.get('writeErrors', []):
+        order_document = order_documents[write_error['index']]
+        if write_error.get('code') == DUPLICATE_KEY_ERROR:
+            print(f"Order from email {order_document.get('message_id')} was already ingested, skipping.")
+            continue
+        print(f"Failed to insert order {order_document['_id']} for route {order_document.get('route')}: "
+              f"{write_error.get('errmsg')}")
+        failures.append((order_document, write_error.get('errmsg')))
+    return failures
 
 
 # Example usage
 # parsed_data = parse_email(raw_email_content)
 # insert_order_into_mongodb(parsed_data)
+def ensure_order_indexes(client, db_name='mydatabase', orders_collection='orders'):
+    """
+    Creates the orders indexes, including the unique message_id index that
+    makes order ingestion idempotent (see operations.indexes).
+    """
+    create_collection_indexes(client, 'orders', db_name, orders_collection)
+
+
 def get_last_parsed_email_id(client, db_name='mydatabase', status_collection='status'):
     db = client[db_name]
     collection = db[status_collection]
@@ -249,6 +357,57 @@ def get_last_parsed_email_id(client, db_name='mydatabase', status_collection='st
     return last_parsed_email_id
 
 
+def get_uid_watermark(client, db_name='mydatabase', status_collection='status'):
+    """
+    Returns the (uidvalidity, last_uid) pair stored for the order inbox, or (None, None).
+    """
+    db = client[db_name]
+    collection = db[status_collection]
+    status_document = collection.find_one({'variable': 'last_parsed'})
+    if not status_document:
+        return None, None
+    return status_document.get('uidvalidity'), status_document.get('value')
+
+
+def save_uid_watermark(client, uidvalidity, last_uid, db_name='mydatabase', status_collection='status'):
+    """
+    Stores the UID of the last processed email together with the mailbox UIDVALIDITY.
+    """
+    db = client[db_name]
+    collection = db[status_collection]
+
+    advance, reset = uid_watermark_updates(uidvalidity, last_uid)
+    result = collection.update_one(*advance)
+    if result.matched_count == 0:
+        collection.update_one(*reset, upsert=True)
+
+
+def cap_uid_watermark(highest_uid, unwritten_uids):
+    """
+    Returns the UID the watermark can move to after a pass.
+
+    That is highest_uid, unless some orders were not written: then it stops just
+    below the first of them so the next pass fetches it again.
+    """
+    return min(unwritten_uids) - 1 if unwritten_uids else highest_uid
+
+
+def uid_watermark_updates(uidvalidity, last_uid):
+    """
+    Builds the two status updates that store the UID watermark.
+
+    :return: Tuple of (filter, update) pairs: the first advances the watermark of
+             the same UIDVALIDITY, the second replaces it when nothing matched.
+    """
+    now = datetime.now()
+    # $max keeps the watermark from moving backwards when several workers poll at once
+    advance = ({'variable': 'last_parsed', 'uidvalidity': uidvalidity},
+               {'$max': {'value': last_uid}, '$set': {'updated_at': now}})
+    reset = ({'variable': 'last_parsed'},
+             {'$set': {'value': last_uid, 'uidvalidity': uidvalidity, 'updated_at': now}})
+    return advance, reset
+
+
 def get_latest_email_id(email_address, password):
     mail = imaplib.IMAP4_SSL('imap.gmail.com')
     mail.login(email_address, password)
@@ -263,51 +422,154 @@ def get_latest_email_id(email_address, password):
     return last_email_id
 
 
-def fetch_unread_emails(email_address, password):
+def search_new_email_uids(mail, last_uid=None):
     """
-    Fetches unread emails from the Gmail account.
-    """
-    mail = imaplib.IMAP4_SSL('imap.gmail.com')
-    mail.login(email_address, password)
-    mail.select('inbox')
+    Returns the UIDs of the emails that arrived after the stored UID watermark.
 
-    # Search for unread emails
-    result, data = mail.search(None, 'UNSEEN')
-    if result != 'OK':
-        print("Failed to retrieve unread emails.")
-        return []
+    Without a usable watermark (first run, or the mailbox UIDVALIDITY changed)
+    the unread emails are picked up instead, as the poller used to do.
+
+    :param mail: Logged in IMAP session with the mailbox selected.
+    :param last_uid: UID of the last processed email, or None.
+    :return: List of UIDs in ascending order.
+    """
+    if last_uid is None:
+        uids = search_uids(mail, 'UNSEEN')
+    else:
+        uids = search_uids_after(mail, last_uid)
 
-    if data is None:
+    if not uids:
         print("All orders parsed")
+    return uids
 
-    email_ids = data[0].split()
-    emails = []
 
-    for e_id in email_ids:
-        result, email_data = mail.fetch(e_id, '(RFC822)')
-        if result == 'OK':
-            emails.append(email_data[0][1])
+def find_route_order_uids(mail, uids):
+    """
+    Returns the candidate UIDs whose subject marks them as route orders.
+
+    Only the Subject and Message-ID headers are fetched, with BODY.PEEK and in
+    chunks of IMAP_FETCH_CHUNK_SIZE.
+    """
+    parser = BytesParser(policy=policy.default)
+
+    order_uids = []
+    for uid, raw_headers in fetch_messages(mail, uids, ORDER_HEADER_FIELDS):
+        headers = parser.parsebytes(raw_headers, headersonly=True)
+        if is_route_order_subject(headers['Subject']):
+            order_uids.append(uid)
+    return order_uids
+
+
+def fetch_raw_route_order_emails(mail, uids):
+    """
+    Fetches route order emails in two phases.
+
+    Headers are fetched for every candidate first (see find_route_order_uids);
+    full bodies are then downloaded for the route orders alone, so the \\Seen
+    flag is left untouched and a backlog does not cost one round trip per email.
+
+    :param mail: Logged in IMAP session with the mailbox selected.
+    :param uids: Candidate UIDs in ascending order.
+    :return: Generator of (uid, raw_email) tuples for route orders only.
+    """
+    return fetch_messages(mail, find_route_order_uids(mail, uids))
 
-    mail.close()
-    mail.logout()
-    return emails
+
+def is_route_order_subject(subject):
+    return ORDER_SUBJECT_MARKER in str(subject or '')
+
+
+def process_new_order_emails(mail, client, db_name='mydatabase', orders_collection='orders', mailbox='inbox'):
+    """
+    Processes every email past the UID watermark on an open IMAP session.
+
+    All orders parsed in the pass are written with a single insert_many, and the
+    watermark only moves once that write has gone through, so a run that crashes
+    halfway is simply repeated by the next poll. Orders that fail to insert hold
+    the watermark below their UID, so they are retried too.
+
+    :return: Number of route orders parsed in the pass.
+    """
+    uidvalidity = select_mailbox(mail, mailbox)
+    stored_uidvalidity, last_uid = get_uid_watermark(client, db_name)
+    if last_uid is not None and stored_uidvalidity != uidvalidity:
+        print(f"UIDVALIDITY changed from {stored_uidvalidity} to {uidvalidity}, resetting watermark.")
+        last_uid = None
+
+    # On a fresh watermark, remember where the mailbox currently ends so the next poll starts there
+    highest_uid = max(search_uids(mail, 'UID *'), default=0) if last_uid is None else last_uid
+
+    uids = search_new_email_uids(mail, last_uid)
+    highest_uid = max([highest_uid] + uids)
+
+    parser = BytesParser(policy=policy.default)
+    order_documents = []
+    order_uids = {}
+    for uid, raw_email in fetch_raw_route_order_emails(mail, uids):
+        email_message = parser.parsebytes(raw_email)
+        extracted_data = parse_email_content(email_message)
+        # Keep the original so the order can be re-parsed later (see the replay_archive command)
+        archive_raw(client, raw_email, ORDER_EMAIL, get_received_at(email_message), db_name,
+                    message_id=extracted_data['message_id'])
+        order_document = build_order_document(extracted_data)
+        if order_document is not None:
+            order_documents.append(order_document)
+            order_uids[order_document['_id']] = uid
+
+    failures = insert_orders_into_mongodb(order_documents, client, db_name, orders_collection)
+
+    # Orders that failed to insert are fetched again by the next pass
+    failed_uids = [order_uids[order_document['_id']] for order_document, _ in failures]
+    watermark = cap_uid_watermark(highest_uid, failed_uids)
+    if last_uid is None or watermark > last_uid:
+        save_uid_watermark(client, uidvalidity, watermark, db_name)
+    return len(order_documents)
 
 
 def check_and_parse_new_emails(email_address, email_password, client, db_name='mydatabase', orders_collection='orders'):
     """
-    Fetches unread emails, parses them, and inserts order details into MongoDB.
+    Fetches new emails, parses them, and inserts order details into MongoDB.
     """
-    unread_emails = fetch_unread_emails(email_address, email_password)
+    mail = connect_imap(email_address, email_password)
+    try:
+        process_new_order_emails(mail, client, db_name, orders_collection)
+    finally:
+        close_imap(mail)
 
-    for raw_email in unread_emails:
-        email_message = email_lib.message_from_bytes(raw_email)
-        subject = str(email_lib.header.make_header(email_lib.header.decode_header(email_message['Subject'])))
 
-        # Updated condition to check the subject line
-        if 'Route Order for' in subject:
-            parsed_data = parse_email_content(raw_email)
-            if parsed_data is not None:
-                insert_order_into_mongodb(parsed_data, client, db_name, orders_collection)
+def watch_order_inbox(email_address, email_password, client, db_name='mydatabase', orders_collection='orders',
+                      idle_timeout=None, max_backoff=300):
+    """
+    Keeps one IMAP session open and ingests orders as soon as they arrive.
+
+    New mail is awaited with IMAP IDLE; every wake-up (or idle timeout) runs the
+    same watermark-based pass as the scheduled poll. Dropped connections are
+    re-established with exponential backoff. Runs until interrupted.
+    """
+    backoff = 1
+    while True:
+        mail = None
+        try:
+            mail = connect_imap(email_address, email_password)
+            backoff = 1
+            print("Connected to IMAP, waiting for new orders.")
+            while True:
+                if process_new_order_emails(mail, client, db_name, orders_collection):
+                    # Pre-render the pick sheets of the new orders
+                    queue_order_pdf_render()
+                idle_wait(mail, idle_timeout)
+        except Exception as e:
+            # Anything else (a bad email, a parser bug) is retried too rather than stopping the daemon
+            print(f"Order ingestion interrupted: {e!r}. Reconnecting in {backoff}s.")
+        finally:
+            if mail is not None:
+                try:
+                    mail.logout()
+                except (imaplib.IMAP4.error, OSError):
+                    pass
+
+        time.sleep(backoff)
+        backoff = min(backoff * 2, max_backoff)
 
 
 def parse_and_reorder_email(email_content, client):
@@ -315,7 +577,7 @@ def parse_and_reorder_email(email_content, client):
     extracted_data = parse_email_content(email_content)
 
     # Fetch the ordering for items
-    items_ordering = fetch_item_ordering(client)
+    items_ordering = get_item_ordering(client)
 
     # Reorder items based on fetched order
     if 'items' in extracted_data and extracted_data['items']:
@@ -335,7 +597,17 @@ def order_main():
     password = os.getenv('EMAIL_PASSWORD')
     uri = os.getenv('DB_URI')
 
-    client = MongoClient(uri)
+    client = get_client()
+
+    ensure_order_indexes(client, 'mydatabase', 'orders')
+
+    if os.getenv('ORDER_PIPELINE_MODE') == 'async':
+        # Imported here so Motor is only needed when the async pipeline is enabled
+        from operations.order_pipeline import run_order_pipeline
+        asyncio.run(run_order_pipeline(email, password, uri, 'mydatabase', 'orders'))
+    else:
+        check_and_parse_new_emails(email, password, client, 'mydatabase', 'orders')
 
-    check_and_parse_new_emails(email, password, client, 'mydatabase', 'orders')
+    # Pre-render the pick sheets of new orders
+    queue_order_pdf_render()
 
@@ -0,0 +1,6 @@
+# Several operations modules read their settings from the environment at import time
+# (pool sizes, chunk sizes, worker counts, pipeline modes). Load .env here so those
+# reads see it no matter which module is imported first.
+from dotenv import load_dotenv
+
+load_dotenv()
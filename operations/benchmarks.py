@@ -0,0 +1,276 @@
+import io
+import math
+import random
+import re
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from email.message import EmailMessage
+from email.parser import BytesParser
+from email import policy
+from email.utils import make_msgid, format_datetime
+
+from operations.Order_Backend import parse_email_content, extract_table_from_html, extract_table_from_html_bs4, \
+    insert_order_into_mongodb, ensure_order_indexes, process_new_order_emails
+from operations.item_ordering import get_item_ordering, reorder_items
+
+BENCHMARK_DB = 'ingestion_benchmark'
+
+ROUTES = ['RTC000003', 'RTC000013', 'RTC000018', 'RTC000127', 'RTC000433', 'RTC000700', 'RTC000731']
+PRODUCT_WORDS = ['Sparkling', 'Still', 'Water', 'Cola', 'Lime', 'Lemon', 'Tea', 'Green', 'Zero', 'Juice', 'Orange',
+                 'Energy', 'Cold Brew', 'Coffee', 'Mango', 'Berry']
+PACK_SIZES = ['6pk', '12pk', '24pk', '1L', '2L', '500ml']
+CATALOG_START = 10000
+CATALOG_SIZE = 400
+
+
+def generate_route_order_email(rng, item_count, forwarded=False):
+    """
+    Builds a multipart route order email shaped like the ones the route system sends.
+
+    :return: Raw email bytes.
+    """
+    route_number = rng.choice(ROUTES)
+    pick_up = datetime(2024, 1, 1) + timedelta(days=rng.randint(0, 365), hours=rng.choice([5, 6, 7, 11]))
+    item_numbers = rng.sample(range(CATALOG_START, CATALOG_START + CATALOG_SIZE), item_count)
+
+    details = (f"Route Name: Route {route_number[-3:]}\n"
+               f"Route Number: {route_number}\n"
+               f"Pick up Date: {pick_up.strftime('%m/%d/%Y %I:%M %p').lstrip('0')}\n")
+    rows = ''.join(
+        f'<tr><td style="padding:4px">{item_number}</td>'
+        f'<td style="padding:4px">{" ".join(rng.sample(PRODUCT_WORDS, 2))} {rng.choice(PACK_SIZES)}</td>'
+        f'<td style="padding:4px" align="right">{rng.randint(1, 40)}</td></tr>'
+        for item_number in item_numbers
+    )
+    html = (f'<html><head><meta http-equiv="Content-Type" content="text/html; charset=utf-8"></head><body><p>{details.replace(chr(10), "<br>")}</p>'
+            f'<table width="100%"><tr><td><table border="1">'
+            f'<tr><th>Item</th><th>Description</th><th>Quantity</th></tr>{rows}'
+            f'</table></td></tr></table></body></html>')
+
+    subject = f"Route Order for {route_number}"
+    if forwarded:
+        subject = f"Fwd: {subject}"
+        details = f"---------- Forwarded message ---------\nFrom: Route System\n\n{details}"
+        html = html.replace('<body>', '<body><div>---------- Forwarded message ---------</div><blockquote>', 1)
+        html = html.replace('</body>', '</blockquote></body>', 1)
+
+    message = EmailMessage()
+    message['Subject'] = subject
+    message['From'] = 'orders@example.com'
+    message['To'] = 'warehouse@example.com'
+    message['Date'] = format_datetime(pick_up - timedelta(days=1))
+    message['Message-ID'] = make_msgid(domain='example.com')
+    message.set_content(details)
+    message.add_alternative(html, subtype='html')
+    return message.as_bytes()
+
+
+def generate_noise_email(rng):
+    """
+    Builds a non-order email (newsletter with an attachment) that ingestion should skip.
+    """
+    message = EmailMessage()
+    message['Subject'] = rng.choice(['Weekly newsletter', 'Re: schedule', 'Invoice attached'])
+    message['From'] = 'news@example.com'
+    message['Message-ID'] = make_msgid(domain='example.com')
+    message.set_content('Nothing to see here.\n' * 20)
+    message.add_attachment(rng.randbytes(200 * 1024), maintype='application', subtype='octet-stream',
+                           filename='attachment.bin')
+    return message.as_bytes()
+
+
+def generate_corpus(count, min_items=10, max_items=300, forwarded_ratio=0.2, noise_ratio=0.5, seed=0):
+    """
+    Generates a mailbox of route orders mixed with noise emails.
+
+    :return: Dict of UID -> raw email bytes.
+    """
+    rng = random.Random(seed)
+    messages = {}
+    uid = 1
+    orders = 0
+    while orders < count:
+        if rng.random() < noise_ratio:
+            messages[uid] = generate_noise_email(rng)
+        else:
+            messages[uid] = generate_route_order_email(rng, rng.randint(min_items, max_items),
+                                                       forwarded=rng.random() < forwarded_ratio)
+            orders += 1
+        uid += 1
+    return messages
+
+
+class InMemoryIMAP:
+    """
+    In-process stand-in for imaplib.IMAP4_SSL serving a fixed mailbox.
+
+    Supports the subset of commands ingestion uses: SELECT, UID SEARCH
+    (ALL, UNSEEN, UID n:*, UID *) and UID FETCH of full bodies or header fields.
+    """
+
+    capabilities = ('IMAP4REV1', 'IDLE')
+
+    def __init__(self, messages, uidvalidity=1):
+        self.messages = dict(sorted(messages.items()))
+        self.uidvalidity = uidvalidity
+        self.seen = set()
+        self.round_trips = 0
+        self.bytes_sent = 0
+
+    def login(self, user, password):
+        return 'OK', [b'Logged in']
+
+    def select(self, mailbox='INBOX', readonly=False):
+        self.round_trips += 1
+        return 'OK', [str(len(self.messages)).encode()]
+
+    def response(self, code):
+        if code == 'UIDVALIDITY':
+            return code, [str(self.uidvalidity).encode()]
+        return code, [None]
+
+    def uid(self, command, *args):
+        self.round_trips += 1
+        if command == 'SEARCH':
+            return 'OK', [' '.join(str(uid) for uid in self._search(args[-1])).encode()]
+        if command == 'FETCH':
+            return 'OK', self._fetch(args[0], args[1])
+        raise ValueError(f"Unsupported UID command {command}")
+
+    def _search(self, criteria):
+        uids = list(self.messages)
+        if criteria == 'UNSEEN':
+            return [uid for uid in uids if uid not in self.seen]
+        if criteria == 'UID *':
+            return uids[-1:]
+        match = re.match(r'UID (\d+):\*', criteria)
+        if match:
+            low = int(match.group(1))
+            return [uid for uid in uids if uid >= low] or uids[-1:]
+        return uids
+
+    def _fetch(self, message_set, message_parts):
+        data = []
+        for uid in self._expand(message_set):
+            raw_email = self.messages[uid]
+            fields = re.search(r'HEADER\.FIELDS \(([^)]*)\)', message_parts)
+            if fields:
+                wanted = fields.group(1).lower().split()
+                headers = raw_email.split(b'\n\n', 1)[0].split(b'\n')
+                raw_email = b'\r\n'.join(line for line in headers
+                                         if line.split(b':', 1)[0].decode().lower() in wanted) + b'\r\n\r\n'
+            elif 'PEEK' not in message_parts:
+                self.seen.add(uid)
+            self.bytes_sent += len(raw_email)
+            data.append((f'{uid} (UID {uid} BODY[] {{{len(raw_email)}}}'.encode(), raw_email))
+            data.append(b')')
+        return data
+
+    def _expand(self, message_set):
+        for part in message_set.split(','):
+            low, _, high = part.partition(':')
+            for uid in range(int(low), int(high or low) + 1):
+                if uid in self.messages:
+                    yield uid
+
+    def close(self):
+        return 'OK', [b'Closed']
+
+    def logout(self):
+        return 'BYE', [b'Logging out']
+
+
+def mongomock_client():
+    """
+    Returns a mongomock client that the raw archive's GridFS bucket can write to.
+    """
+    import mongomock
+    import mongomock.gridfs
+
+    mongomock.gridfs.enable_gridfs_integration()
+    client = mongomock.MongoClient()
+    # GridFSBucket reads client.options.timeout, which mongomock does not provide
+    client.options = SimpleNamespace(timeout=None)
+    return client
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    def report(self):
+        """
+        Returns one row per stage: name, calls, total seconds, calls/s, p50 ms, p95 ms.
+        """
+        rows = []
+        for stage, samples in self.samples.items():
+            total = sum(samples)
+            rows.append((stage, len(samples), total, len(samples) / total if total else float('inf'),
+                         percentile(samples, 0.5) * 1000, percentile(samples, 0.95) * 1000))
+        return rows
+
+
+def seed_catalog(client, db_name=BENCHMARK_DB, catalog_size=CATALOG_SIZE):
+    """
+    Loads an items catalog covering every generated item number so reorder_items has real work.
+    """
+    item_numbers = list(range(CATALOG_START, CATALOG_START + catalog_size))
+    random.Random(catalog_size).shuffle(item_numbers)
+    client[db_name]['items'].insert_many([
+        {'ItemNumber': str(item_number), 'Orderby': index} for index, item_number in enumerate(item_numbers)
+    ])
+
+
+def run_ingestion_benchmark(client, count=200, min_items=10, max_items=300, forwarded_ratio=0.2, seed=0):
+    """
+    Measures each ingestion stage and the end-to-end poll over a synthetic mailbox.
+
+    Writes go to the BENCHMARK_DB database on the given client, which is dropped
+    before and after the run.
+
+    :return: (StageTimer, InMemoryIMAP) so callers can report timings and IMAP traffic.
+    """
+    messages = generate_corpus(count, min_items, max_items, forwarded_ratio, seed=seed)
+    client.drop_database(BENCHMARK_DB)
+    # The backends print a line per order; keep that cost in the timings but out of the report
+    try:
+        with redirect_stdout(io.StringIO()):
+            seed_catalog(client, BENCHMARK_DB)
+            ensure_order_indexes(client, BENCHMARK_DB, 'orders')
+
+            timer = StageTimer()
+            parser = BytesParser(policy=policy.default)
+            order_emails = [raw_email for raw_email in messages.values() if b'Route Order for' in raw_email[:2048]]
+
+            for raw_email in order_emails:
+                email_message = timer.time('mime_parse', parser.parsebytes, raw_email)
+                extracted_data = timer.time('parse_email_content', parse_email_content, email_message)
+
+                html_body = email_message.get_body(('html',)).get_content()
+                timer.time('extract_table_from_html', extract_table_from_html, html_body, {'items': []})
+                timer.time('extract_table_from_html_bs4', extract_table_from_html_bs4, html_body, {'items': []})
+
+                items_ordering = timer.time('get_item_ordering', get_item_ordering, client, BENCHMARK_DB)
+                timer.time('reorder_items', reorder_items, list(extracted_data['items']), items_ordering)
+                timer.time('insert_order_into_mongodb', insert_order_into_mongodb, extracted_data, client,
+                           BENCHMARK_DB, 'orders')
+
+            # End to end: the same mailbox through the real poll, into a fresh collection
+            mail = InMemoryIMAP(messages)
+            timer.time('process_new_order_emails', process_new_order_emails, mail, client, BENCHMARK_DB, 'orders_e2e')
+            return timer, mail
+    finally:
+        client.drop_database(BENCHMARK_DB)
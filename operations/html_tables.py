@@ -0,0 +1,151 @@
+from html.entities import html5
+from html.parser import HTMLParser
+
+HTML_ENTITIES = {}
+for _name, _character in html5.items():
+    HTML_ENTITIES.setdefault(_name.rstrip(';'), _character)
+
+# Elements BeautifulSoup closes as soon as they open
+VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta', 'param',
+    'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer',
+}
+
+# Text inside these is left out of BeautifulSoup's get_text()
+HIDDEN_TEXT_ELEMENTS = {'script', 'style', 'template', 'rt', 'rp'}
+
+
+class _Element:
+    __slots__ = ('name', 'rows', 'cells', 'text')
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = [] if name == 'table' else None
+        self.cells = [] if name == 'tr' else None
+        self.text = [] if name == 'td' else None
+
+
+class TableRowParser(HTMLParser):
+    """
+    Collects the td text of every table row without building a document tree.
+
+    Mirrors what BeautifulSoup's html.parser tree gives for
+    table.find_all('tr') / row.find_all('td') / td.get_text(strip=True):
+    rows and cells are matched at any depth (so nested tables show up in their
+    ancestors too), end tags close everything opened after the matching start
+    tag, unmatched end tags are ignored, and void elements follow the same
+    already-closed bookkeeping as BeautifulSoup's html.parser builder.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.tables = []
+        self.stack = []
+        self.already_closed = []
+        self.data = []
+
+    def handle_starttag(self, tag, attrs, handle_empty_element=True):
+        self.flush_data()
+
+        element = _Element(tag)
+        if tag == 'table':
+            self.tables.append(element)
+        elif tag == 'tr':
+            for open_element in self.stack:
+                if open_element.rows is not None:
+                    open_element.rows.append(element)
+        elif tag == 'td':
+            for open_element in self.stack:
+                if open_element.cells is not None:
+                    open_element.cells.append(element)
+        self.stack.append(element)
+
+        if tag in VOID_ELEMENTS and handle_empty_element:
+            # Closed straight away; a later explicit end tag for it is ignored once
+            self.handle_endtag(tag, check_already_closed=False)
+            self.already_closed.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, handle_empty_element=False)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag, check_already_closed=True):
+        if check_already_closed and tag in self.already_closed:
+            self.already_closed.remove(tag)
+            return
+
+        self.flush_data()
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index].name == tag:
+                del self.stack[index:]
+                break
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        try:
+            codepoint = int(name[1:], 16) if name[0] in 'xX' else int(name)
+        except ValueError:
+            self.data.append('\N{REPLACEMENT CHARACTER}')
+            return
+
+        character = None
+        if codepoint < 256:
+            # Same windows-1252 reading of C1 control references as BeautifulSoup
+            try:
+                character = bytes([codepoint]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+        if not character:
+            try:
+                character = chr(codepoint)
+            except (ValueError, OverflowError):
+                pass
+        self.data.append(character or '\N{REPLACEMENT CHARACTER}')
+
+    def handle_entityref(self, name):
+        character = HTML_ENTITIES.get(name)
+        self.data.append(character if character is not None else f'&{name}')
+
+    def handle_comment(self, data):
+        self.flush_data()
+
+    def handle_decl(self, decl):
+        self.flush_data()
+
+    def handle_pi(self, data):
+        self.flush_data()
+
+    def unknown_decl(self, data):
+        self.flush_data()
+
+    def flush_data(self):
+        if not self.data:
+            return
+        text = ''.join(self.data).strip()
+        self.data = []
+        if not text or any(element.name in HIDDEN_TEXT_ELEMENTS for element in self.stack):
+            return
+        for element in self.stack:
+            if element.text is not None:
+                element.text.append(text)
+
+    def close(self):
+        super().close()
+        self.flush_data()
+
+    def iter_rows(self):
+        """
+        Yields the td texts of every row, table by table, skipping each table's first row.
+        """
+        for table in self.tables:
+            for row in table.rows[1:]:
+                yield [''.join(cell.text) for cell in row.cells]
+
+
+def extract_table_rows(html_body):
+    parser = TableRowParser()
+    parser.feed(html_body)
+    parser.close()
+    return parser.iter_rows()
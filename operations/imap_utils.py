@@ -0,0 +1,393 @@
+import base64
+import imaplib
+import os
+import quopri
+import re
+import select
+import ssl
+import time
+from email.header import decode_header, make_header
+from email.utils import collapse_rfc2231_value, decode_rfc2231
+
+IMAP_HOST = 'imap.gmail.com'
+
+# Number of messages requested per FETCH command when draining a backlog
+IMAP_FETCH_CHUNK_SIZE = int(os.getenv('IMAP_FETCH_CHUNK_SIZE', '50'))
+
+# Gmail ends IDLE sessions after ~29 minutes, so re-issue it well before that
+IMAP_IDLE_TIMEOUT = int(os.getenv('IMAP_IDLE_TIMEOUT', str(25 * 60)))
+
+# Seconds a socket read may stall before the connection is treated as dead
+IMAP_SOCKET_TIMEOUT = int(os.getenv('IMAP_SOCKET_TIMEOUT', '60'))
+
+UID_PATTERN = re.compile(rb'UID (\d+)')
+
+
+def connect_imap(email_address, password):
+    """
+    Opens an authenticated IMAP session against Gmail.
+
+    :param email_address: Your Gmail email address.
+    :param password: Your Gmail password or app-specific password.
+    :return: Logged in imaplib.IMAP4_SSL instance.
+    """
+    # Without a timeout a half-open connection blocks readline forever
+    mail = imaplib.IMAP4_SSL(IMAP_HOST, timeout=IMAP_SOCKET_TIMEOUT)
+    mail.login(email_address, password)
+    return mail
+
+
+def select_mailbox(mail, mailbox='inbox'):
+    """
+    Selects a mailbox and returns its UIDVALIDITY.
+
+    UIDs are only stable while UIDVALIDITY stays the same, so callers storing
+    a UID watermark must store this value next to it.
+    """
+    result, _ = mail.select(mailbox)
+    if result != 'OK':
+        raise imaplib.IMAP4.error(f"Failed to select mailbox {mailbox}")
+
+    _, data = mail.response('UIDVALIDITY')
+    if data and data[0]:
+        return int(data[0])
+
+    # Fall back to an explicit STATUS query if the untagged response was not captured
+    result, data = mail.status(mailbox, '(UIDVALIDITY)')
+    if result == 'OK' and data and data[0]:
+        return int(data[0].split(b'UIDVALIDITY')[1].strip(b' )'))
+    return None
+
+
+def search_uids(mail, criteria):
+    """
+    Runs a UID SEARCH and returns the matching UIDs as sorted integers.
+    """
+    result, data = mail.uid('SEARCH', None, criteria)
+    if result != 'OK' or not data or not data[0]:
+        return []
+    return sorted(int(uid) for uid in data[0].split())
+
+
+def search_uids_after(mail, last_uid):
+    """
+    Returns the UIDs strictly greater than last_uid.
+
+    `UID SEARCH UID n:*` always matches the newest message even when its UID
+    is below n, so the result is filtered again on our side.
+    """
+    uids = search_uids(mail, f'UID {last_uid + 1}:*')
+    return [uid for uid in uids if uid > last_uid]
+
+
+def format_uid_set(uids):
+    """
+    Collapses a sorted list of UIDs into an IMAP message set, e.g. [1, 2, 3, 7] -> '1:3,7'.
+    """
+    ranges = []
+    start = previous = None
+    for uid in uids:
+        if start is None:
+            start = previous = uid
+        elif uid == previous + 1:
+            previous = uid
+        else:
+            ranges.append(f'{start}:{previous}' if start != previous else str(start))
+            start = previous = uid
+    if start is not None:
+        ranges.append(f'{start}:{previous}' if start != previous else str(start))
+    return ','.join(ranges)
+
+
+def parse_fetch_response(data):
+    """
+    Pairs each literal in a UID FETCH response with the UID it belongs to.
+
+    imaplib returns a list mixing (envelope, literal) tuples and closing byte
+    strings; the UID is usually in the envelope but some servers send it after
+    the literal instead.
+    """
+    pending = None
+    for item in data:
+        if isinstance(item, tuple):
+            match = UID_PATTERN.search(item[0])
+            if match:
+                yield int(match.group(1)), item[1]
+            else:
+                pending = item[1]
+        elif pending is not None and item:
+            match = UID_PATTERN.search(item)
+            if match:
+                yield int(match.group(1)), pending
+            pending = None
+
+
+def fetch_messages(mail, uids, message_parts='(BODY.PEEK[])', chunk_size=None):
+    """
+    Fetches many messages with one UID FETCH per chunk instead of one per message.
+
+    :param mail: Logged in IMAP session with the mailbox selected.
+    :param uids: UIDs to fetch, in the order they should be processed.
+    :param message_parts: FETCH data items to request for each message.
+    :param chunk_size: Messages per FETCH command, defaults to IMAP_FETCH_CHUNK_SIZE.
+    :return: Generator of (uid, payload) tuples in the order of uids.
+    """
+    chunk_size = chunk_size or IMAP_FETCH_CHUNK_SIZE
+    for start in range(0, len(uids), chunk_size):
+        chunk = uids[start:start + chunk_size]
+        result, data = mail.uid('FETCH', format_uid_set(sorted(chunk)), message_parts)
+        if result != 'OK':
+            # Stop here so callers tracking a watermark never skip past the failed chunk
+            raise imaplib.IMAP4.error(f"Failed to fetch messages {chunk[0]}-{chunk[-1]}")
+
+        payloads = dict(parse_fetch_response(data))
+        for uid in chunk:
+            if uid in payloads:
+                yield uid, payloads[uid]
+
+
+def parse_imap_data(buffer):
+    """
+    Parses IMAP response data into Python values.
+
+    Parenthesized lists become lists, NIL becomes None, and atoms, quoted
+    strings and {n} literals become str. Atoms may carry a bracketed section,
+    as in BODY[HEADER.FIELDS (DATE)].
+
+    :param buffer: Response bytes with any literals inlined after their {n} marker.
+    :return: List of the top-level values.
+    """
+    values, _ = _parse_imap_values(buffer, 0, top_level=True)
+    return values
+
+
+def _parse_imap_values(buffer, position, top_level=False):
+    values = []
+    length = len(buffer)
+    while position < length:
+        char = buffer[position:position + 1]
+        if char in b' \r\n':
+            position += 1
+        elif char == b'(':
+            value, position = _parse_imap_values(buffer, position + 1)
+            values.append(value)
+        elif char == b')':
+            if top_level:
+                raise ValueError(f"Unbalanced ')' at {position}")
+            return values, position + 1
+        elif char == b'"':
+            end = position + 1
+            chunk = bytearray()
+            while buffer[end:end + 1] != b'"':
+                if end >= length:
+                    raise ValueError("Unterminated quoted string")
+                if buffer[end:end + 1] == b'\\':
+                    end += 1
+                chunk += buffer[end:end + 1]
+                end += 1
+            values.append(chunk.decode('utf-8', 'replace'))
+            position = end + 1
+        elif char == b'{':
+            end = buffer.index(b'}', position)
+            size = int(buffer[position + 1:end])
+            start = end + 1
+            if buffer[start:start + 2] == b'\r\n':
+                start += 2
+            values.append(buffer[start:start + size].decode('utf-8', 'replace'))
+            position = start + size
+        else:
+            end = position
+            depth = 0
+            while end < length:
+                char = buffer[end:end + 1]
+                if char == b'[':
+                    depth += 1
+                elif char == b']':
+                    depth -= 1
+                elif depth == 0 and char in b' ()\r\n':
+                    break
+                end += 1
+            atom = buffer[position:end].decode('utf-8', 'replace')
+            values.append(None if atom.upper() == 'NIL' else atom)
+            position = end
+    if not top_level:
+        raise ValueError("Unbalanced '('")
+    return values, position
+
+
+def join_fetch_response(data):
+    """
+    Rebuilds the raw bytes of a FETCH response from imaplib's list of lines and (line, literal) tuples.
+    """
+    pieces = []
+    for item in data:
+        if isinstance(item, tuple):
+            pieces.append(item[0] + b'\r\n' + item[1])
+        elif item:
+            pieces.append(item)
+    return b' '.join(pieces)
+
+
+def fetch_message_items(mail, uids, message_parts, chunk_size=None):
+    """
+    Fetches FETCH data items such as BODYSTRUCTURE, one UID FETCH per chunk.
+
+    :return: Generator of (uid, {item name: value}) tuples in the order of uids.
+    """
+    chunk_size = chunk_size or IMAP_FETCH_CHUNK_SIZE
+    for start in range(0, len(uids), chunk_size):
+        chunk = uids[start:start + chunk_size]
+        result, data = mail.uid('FETCH', format_uid_set(sorted(chunk)), message_parts)
+        if result != 'OK':
+            raise imaplib.IMAP4.error(f"Failed to fetch messages {chunk[0]}-{chunk[-1]}")
+
+        items_by_uid = {}
+        values = parse_imap_data(join_fetch_response(data))
+        # Responses come as `<sequence number> (<name> <value> ...)`
+        for attributes in values[1::2]:
+            items = {str(name).upper(): value for name, value in zip(attributes[::2], attributes[1::2])}
+            if 'UID' in items:
+                items_by_uid[int(items['UID'])] = items
+        for uid in chunk:
+            if uid in items_by_uid:
+                yield uid, items_by_uid[uid]
+
+
+def iter_body_parts(bodystructure, part_number=''):
+    """
+    Walks a parsed BODYSTRUCTURE and yields (part number, part fields) for every leaf part.
+
+    Part numbers follow RFC 3501: children of a multipart are numbered from 1,
+    and the body of an attached message/rfc822 is numbered below its part.
+    """
+    if isinstance(bodystructure[0], list):
+        for index, child in enumerate(bodystructure, 1):
+            if not isinstance(child, list):
+                break  # The multipart subtype and extension data follow the children
+            yield from iter_body_parts(child, f'{part_number}.{index}' if part_number else str(index))
+        return
+
+    part_number = part_number or '1'
+    yield part_number, bodystructure
+
+    content_type = f'{bodystructure[0]}/{bodystructure[1]}'.lower()
+    if content_type == 'message/rfc822' and len(bodystructure) > 8 and isinstance(bodystructure[8], list):
+        inner = bodystructure[8]
+        yield from iter_body_parts(inner, part_number if isinstance(inner[0], list) else f'{part_number}.1')
+
+
+def get_part_filename(part):
+    """
+    Returns the attachment filename of a BODYSTRUCTURE part, or None.
+
+    Looks at the Content-Disposition filename first, then the Content-Type name,
+    decoding RFC 2231 and RFC 2047 forms.
+    """
+    parameter_lists = []
+    # Basic parts carry the disposition right after the MD5 extension field
+    if len(part) > 8 and isinstance(part[8], list) and len(part[8]) > 1 and isinstance(part[8][1], list):
+        parameter_lists.append((part[8][1], ('filename', 'filename*')))
+    if isinstance(part[2], list):
+        parameter_lists.append((part[2], ('name', 'name*')))
+
+    for parameters, names in parameter_lists:
+        values = {str(key).lower(): value for key, value in zip(parameters[::2], parameters[1::2])}
+        if values.get(names[1]):
+            return collapse_rfc2231_value(decode_rfc2231(values[names[1]]))
+        if values.get(names[0]):
+            return str(make_header(decode_header(values[names[0]])))
+    return None
+
+
+def decode_part(payload, encoding):
+    """
+    Undoes a part's Content-Transfer-Encoding as reported in its BODYSTRUCTURE.
+    """
+    encoding = (encoding or '').lower()
+    if encoding == 'base64':
+        return base64.b64decode(payload)
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(payload)
+    return payload
+
+
+def mark_seen(mail, uids, chunk_size=None):
+    """
+    Sets the \\Seen flag on the given UIDs, which BODY.PEEK fetches leave unset.
+    """
+    chunk_size = chunk_size or IMAP_FETCH_CHUNK_SIZE
+    for start in range(0, len(uids), chunk_size):
+        mail.uid('STORE', format_uid_set(sorted(uids[start:start + chunk_size])), '+FLAGS', '(\\Seen)')
+
+
+def has_buffered_input(mail):
+    """
+    Whether input has already been read off the socket but not consumed yet.
+
+    select() only sees the socket, so it misses lines sitting in imaplib's
+    buffered reader (several untagged responses can arrive in one read) and
+    decrypted bytes held by TLS.
+    """
+    if getattr(mail.sock, 'pending', lambda: 0)():
+        return True
+    timeout = mail.sock.gettimeout()
+    mail.sock.settimeout(0)
+    try:
+        # peek only reads from the socket when the buffer is empty, and won't block here
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        mail.sock.settimeout(timeout)
+
+
+def idle_wait(mail, timeout=None):
+    """
+    Issues IMAP IDLE and blocks until the server reports new mail or the timeout passes.
+
+    imaplib has no IDLE support before Python 3.14, so the command is driven by
+    hand on the underlying socket.
+
+    :param mail: Logged in IMAP session with the mailbox selected.
+    :param timeout: Seconds to wait, defaults to IMAP_IDLE_TIMEOUT.
+    :return: True if new mail arrived, False if the wait timed out.
+    """
+    timeout = timeout or IMAP_IDLE_TIMEOUT
+    if 'IDLE' not in mail.capabilities:
+        raise imaplib.IMAP4.error("Server does not support IDLE")
+
+    tag = mail._new_tag()
+    mail.send(tag + b' IDLE\r\n')
+    response = mail.readline()
+    if not response.startswith(b'+'):
+        raise imaplib.IMAP4.error(f"IDLE was rejected: {response!r}")
+
+    new_mail = False
+    deadline = time.monotonic() + timeout
+    while not new_mail:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not has_buffered_input(mail) and not select.select([mail.sock], [], [], remaining)[0]:
+            break
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed during IDLE")
+        new_mail = line.startswith(b'*') and line.rstrip().endswith(b'EXISTS')
+
+    mail.send(b'DONE\r\n')
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed while leaving IDLE")
+        if line.startswith(tag):
+            break
+    return new_mail
+
+
+def close_imap(mail):
+    try:
+        mail.close()
+    except imaplib.IMAP4.error:
+        pass  # No mailbox was selected
+    mail.logout()
@@ -0,0 +1,140 @@
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+# Every index the app relies on, per collection. Names are fixed so creation is idempotent
+# and the report can match what exists on the server against what is declared here.
+INDEXES = {
+    'orders': [
+        # Makes order ingestion idempotent; orders entered by hand have no message_id
+        IndexModel([('message_id', ASCENDING)], name='message_id_unique', unique=True,
+                   partialFilterExpression={'message_id': {'$type': 'string'}}),
+        # Dashboard pending count and the status filter, newest first
+        IndexModel([('status', ASCENDING), ('_id', DESCENDING)], name='status_id'),
+        # Route filter (rsr_orders_view always has one), newest first
+        IndexModel([('route', ASCENDING), ('_id', DESCENDING)], name='route_id'),
+        # Pick-up date filter
+        IndexModel([('pick_up_date', ASCENDING), ('_id', DESCENDING)], name='pick_up_date_id'),
+    ],
+    'items': [
+        IndexModel([('ItemNumber', ASCENDING)], name='ItemNumber'),
+    ],
+    'mapped_items': [
+        IndexModel([('ItemNumber', ASCENDING)], name='ItemNumber'),
+    ],
+    'transfers': [
+        # verify_order looks transfers up by the order's suffix (operations.transfers); also finds
+        # the transfers key_new_transfers_task still has to key (match_key $exists: false)
+        IndexModel([('match_key', ASCENDING)], name='match_key'),
+    ],
+    'oos_items': [
+        # $merge from the aggregation path matches on it
+        IndexModel([('ItemNumber', ASCENDING)], name='ItemNumber_unique', unique=True),
+    ],
+    'inventory': [
+        # Inventories saved before PDFs were hashed have no pdf_sha256
+        IndexModel([('pdf_sha256', ASCENDING)], name='pdf_sha256_unique', unique=True,
+                   partialFilterExpression={'pdf_sha256': {'$type': 'string'}}),
+    ],
+    'inventory_snapshots': [
+        IndexModel([('sequence', ASCENDING)], name='sequence_unique', unique=True),
+        IndexModel([('taken_at', ASCENDING)], name='taken_at'),
+    ],
+    'status': [
+        IndexModel([('variable', ASCENDING)], name='variable'),
+    ],
+}
+
+# Representative shapes of the queries the views run on every page load, for the explain report
+HOT_QUERIES = [
+    ('orders', {'status': 'Pending'}, None),
+    ('orders', {'status': 'Pending'}, [('_id', DESCENDING)]),
+    ('orders', {'route': 'RTC000003'}, [('_id', DESCENDING)]),
+    ('orders', {'pick_up_date': {'$gte': datetime(2024, 1, 1), '$lt': datetime(2024, 1, 2)}}, [('_id', DESCENDING)]),
+    ('items', {'ItemNumber': '0'}, None),
+    ('mapped_items', {'ItemNumber': {'$nin': ['0']}}, None),
+    ('transfers', {'match_key': '0000'}, None),
+    ('oos_items', {'ItemNumber': '0'}, None),
+    ('inventory', {'pdf_sha256': '0'}, None),
+    ('status', {'variable': 'last_parsed'}, None),
+]
+
+
+def create_collection_indexes(client, collection_key, db_name='mydatabase', collection_name=None):
+    """
+    Creates the indexes declared for one collection. Existing indexes with the same spec are left alone.
+
+    :param collection_key: Key in INDEXES.
+    :param collection_name: Actual collection name, if it differs from the key.
+    :return: Names of the declared indexes.
+    """
+    return client[db_name][collection_name or collection_key].create_indexes(INDEXES[collection_key])
+
+
+def ensure_indexes(client, db_name='mydatabase'):
+    """
+    Creates every declared index, carrying on past collections whose indexes conflict.
+
+    :return: Dict of collection -> error message for the collections that failed.
+    """
+    errors = {}
+    for collection_key in INDEXES:
+        try:
+            create_collection_indexes(client, collection_key, db_name)
+        except OperationFailure as e:
+            errors[collection_key] = str(e)
+    return errors
+
+
+def get_index_report(client, db_name='mydatabase'):
+    """
+    Compares the indexes on the server with INDEXES, using $indexStats for usage.
+
+    :return: Dict of collection -> {'missing': [...], 'undeclared': [...], 'unused': [...]}.
+             Usage counts are since the server last restarted.
+    """
+    db = client[db_name]
+    report = {}
+    for collection_key, models in INDEXES.items():
+        declared = {model.document['name'] for model in models}
+        usage = {stats['name']: stats['accesses']['ops'] for stats in db[collection_key].aggregate([{'$indexStats': {}}])}
+        report[collection_key] = {
+            'missing': sorted(declared - set(usage)),
+            'undeclared': sorted(name for name in usage if name not in declared and name != '_id_'),
+            'unused': sorted(name for name, ops in usage.items() if ops == 0 and name != '_id_'),
+        }
+    return report
+
+
+def explain_hot_queries(client, db_name='mydatabase'):
+    """
+    Explains each query in HOT_QUERIES.
+
+    :return: List of (collection, filter, sort, index name or 'COLLSCAN') tuples.
+    """
+    db = client[db_name]
+    plans = []
+    for collection_name, query, sort in HOT_QUERIES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning_plan = cursor.explain()['queryPlanner']['winningPlan']
+        plans.append((collection_name, query, sort, find_plan_index(winning_plan)))
+    return plans
+
+
+def find_plan_index(plan):
+    """
+    Returns the index an explain plan scans, or the stage name if it reads the collection.
+    """
+    if 'indexName' in plan:
+        return plan['indexName']
+    if plan.get('stage') == 'COLLSCAN':
+        return 'COLLSCAN'
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            found = find_plan_index(child)
+            if found:
+                return found
+    return plan.get('stage')
@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from pymongo.errors import CollectionInvalid
+
+LEVELS_COLLECTION = 'inventory_levels'
+
+
+def ensure_inventory_series(client, db_name='mydatabase'):
+    """
+    Creates the inventory_levels time-series collection: one measurement per item per inventory count.
+    """
+    db = client[db_name]
+    if LEVELS_COLLECTION in db.list_collection_names():
+        return
+    try:
+        db.create_collection(LEVELS_COLLECTION,
+                             timeseries={'timeField': 'taken_at', 'metaField': 'ItemNumber', 'granularity': 'hours'})
+    except CollectionInvalid:
+        pass  # Created by another process in the meantime
+
+
+def record_inventory_levels(client, inventory_data, inventory_id=None, taken_at=None, db_name='mydatabase'):
+    """
+    Adds the case counts of an inventory to the time series.
+
+    Items without a whole-number case count are left out rather than stored as zero.
+
+    :param inventory_id: _id of the inventory document, so backfill_inventory_levels can skip it.
+    :param taken_at: When the count was taken, as naive UTC; defaults to now.
+    """
+    # UTC, like the ObjectId generation times used by the backfill
+    taken_at = taken_at or datetime.utcnow()
+    measurements = [
+        {'taken_at': taken_at, 'ItemNumber': item['ItemNumber'], 'cases': int(item['Cases']),
+         'inventory_id': inventory_id}
+        for item in inventory_data['items'] if str(item.get('Cases') or '').isdigit()
+    ]
+    if measurements:
+        client[db_name][LEVELS_COLLECTION].insert_many(measurements)
+
+
+def backfill_inventory_levels(client, db_name='mydatabase'):
+    """
+    Adds every inventory document that has no measurements yet to the time series.
+
+    This covers the history from before the series existed as well as
+    inventories inserted later with past-dated _ids (replay_archive).
+
+    :return: Number of inventories added.
+    """
+    recorded_ids = client[db_name][LEVELS_COLLECTION].distinct('inventory_id', {'inventory_id': {'$ne': None}})
+    query = {'items.0': {'$exists': True}, '_id': {'$nin': recorded_ids}}
+    count = 0
+    for inventory in client[db_name]['inventory'].find(query).sort('_id', 1):
+        record_inventory_levels(client, inventory, inventory['_id'],
+                                inventory['_id'].generation_time.replace(tzinfo=None), db_name)
+        count += 1
+    return count
+
+
+def load_weekly_levels(client, since=None, db_name='mydatabase'):
+    """
+    Loads the series as a weeks x items matrix of case counts, from `since` (naive UTC).
+
+    Each cell is the last count taken in that week; weeks without a count for
+    an item are NaN.
+
+    :return: DataFrame indexed by week end, one column per ItemNumber.
+    """
+    query = {'taken_at': {'$gte': since}} if since else {}
+    cursor = client[db_name][LEVELS_COLLECTION].find(query, {'_id': 0, 'taken_at': 1, 'ItemNumber': 1, 'cases': 1})
+    measurements = pd.DataFrame(list(cursor), columns=['taken_at', 'ItemNumber', 'cases'])
+    if measurements.empty:
+        return pd.DataFrame()
+
+    levels = measurements.pivot_table(index='taken_at', columns='ItemNumber', values='cases', aggfunc='last')
+    return levels.resample('W').last()
+
+
+def average_depletion(levels, weeks=6):
+    """
+    Mean net weekly decrease in cases over the last `weeks` weeks, per item.
+
+    Positive values mean stock is going down; a restock inside the window pulls
+    the average towards zero or below.
+    """
+    return -levels.diff().tail(weeks).mean()
+
+
+def weeks_of_supply(levels, weeks=6):
+    """
+    Latest case count divided by the average weekly depletion, per item.
+
+    Items that are not being depleted get infinity.
+    """
+    depletion = average_depletion(levels, weeks)
+    latest = levels.ffill().iloc[-1]
+    supply = latest / depletion.where(depletion > 0)
+    return supply.fillna(np.inf).where(latest.notna())
+
+
+def trend_slope(levels, weeks=6):
+    """
+    Least-squares slope of the case counts over the last `weeks` weeks, in cases per week, per item.
+
+    Missing weeks are skipped; items with fewer than two counts get NaN.
+    """
+    window = levels.tail(weeks).to_numpy(dtype=float)
+    present = ~np.isnan(window)
+    x = np.where(present, np.arange(window.shape[0])[:, None], 0.0)
+    counts = present.sum(axis=0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = x.sum(axis=0) / counts
+        y_mean = np.nansum(window, axis=0) / counts
+        x_centered = np.where(present, x - x_mean, 0.0)
+        covariance = np.where(present, x_centered * (window - y_mean), 0.0).sum(axis=0)
+        variance = (x_centered ** 2).sum(axis=0)
+        slope = np.where(variance > 0, covariance / variance, np.nan)
+    return pd.Series(slope, index=levels.columns)
+
+
+def inventory_run_rates(client, weeks=6, db_name='mydatabase'):
+    """
+    Computes the run-rate figures for every item at once.
+
+    :return: DataFrame indexed by ItemNumber with cases, avg_depletion,
+             weeks_of_supply and trend_slope columns.
+    """
+    # One extra week so the first week of the window has a change to measure
+    levels = load_weekly_levels(client, datetime.utcnow() - timedelta(weeks=weeks + 1), db_name)
+    if levels.empty:
+        return pd.DataFrame(columns=['cases', 'avg_depletion', 'weeks_of_supply', 'trend_slope'])
+
+    return pd.DataFrame({
+        'cases': levels.ffill().iloc[-1],
+        'avg_depletion': average_depletion(levels, weeks),
+        'weeks_of_supply': weeks_of_supply(levels, weeks),
+        'trend_slope': trend_slope(levels, weeks),
+    })
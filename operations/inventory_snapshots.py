@@ -0,0 +1,196 @@
+import os
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING
+
+from operations.indexes import create_collection_indexes
+
+# Every this many snapshots a full copy of the items is stored instead of a delta
+INVENTORY_KEYFRAME_INTERVAL = int(os.getenv('INVENTORY_KEYFRAME_INTERVAL', '10'))
+
+# Newest inventory documents that keep their full items; older ones are compacted once
+# snapshotted. At least 1, the latest inventory is read in full.
+INVENTORY_FULL_DOCUMENTS = max(1, int(os.getenv('INVENTORY_FULL_DOCUMENTS', '1')))
+
+SNAPSHOTS_COLLECTION = 'inventory_snapshots'
+
+
+def index_items(items):
+    """
+    Keys inventory items by ItemNumber, keeping their order.
+    """
+    return {item['ItemNumber']: item for item in items}
+
+
+def diff_inventory_items(old_items, new_items):
+    """
+    Returns the delta that turns one inventory's items into another's.
+
+    :param old_items: Dict of ItemNumber -> item, as from index_items.
+    :param new_items: Dict of ItemNumber -> item.
+    :return: Dict with 'upserts' (new or changed items) and 'removals' (ItemNumbers).
+    """
+    return {
+        'upserts': [item for item_number, item in new_items.items() if old_items.get(item_number) != item],
+        'removals': [item_number for item_number in old_items if item_number not in new_items],
+    }
+
+
+def apply_delta(items, delta):
+    """
+    Applies a delta from diff_inventory_items to a dict of ItemNumber -> item, in place.
+    """
+    for item_number in delta['removals']:
+        items.pop(item_number, None)
+    for item in delta['upserts']:
+        items[item['ItemNumber']] = item
+    return items
+
+
+def ensure_snapshot_indexes(client, db_name='mydatabase'):
+    create_collection_indexes(client, SNAPSHOTS_COLLECTION, db_name)
+
+
+def load_snapshot_items(client, snapshot, db_name='mydatabase'):
+    """
+    Rebuilds the items of a snapshot from its keyframe and the deltas after it, with one query.
+
+    :return: Dict of ItemNumber -> item.
+    """
+    chain = client[db_name][SNAPSHOTS_COLLECTION].find(
+        {'sequence': {'$gte': snapshot['keyframe_sequence'], '$lte': snapshot['sequence']}}
+    ).sort('sequence', ASCENDING)
+
+    items = {}
+    for link in chain:
+        if link['kind'] == 'keyframe':
+            items = index_items(link['items'])
+        else:
+            apply_delta(items, link)
+    return items
+
+
+def record_inventory_snapshot(client, inventory_data, inventory_id=None, taken_at=None, db_name='mydatabase'):
+    """
+    Stores an inventory as a delta against the previous snapshot, or as a keyframe.
+
+    A keyframe is written for the first snapshot and whenever the previous
+    keyframe is INVENTORY_KEYFRAME_INTERVAL snapshots old, which bounds how many
+    deltas a reconstruction has to apply.
+
+    :param inventory_data: The inventory document, with its 'items'.
+    :param inventory_id: _id of the inventory document the snapshot was taken from.
+    :param taken_at: When the inventory became current, as naive UTC; defaults to now.
+    :return: The snapshot document.
+    """
+    snapshots = client[db_name][SNAPSHOTS_COLLECTION]
+    previous = snapshots.find_one(sort=[('sequence', DESCENDING)])
+    new_items = index_items(inventory_data['items'])
+
+    snapshot = {
+        'sequence': previous['sequence'] + 1 if previous else 0,
+        # UTC, like the ObjectId generation times used when seeding
+        'taken_at': taken_at or datetime.utcnow(),
+        'inventory_id': inventory_id,
+    }
+    if previous is None or snapshot['sequence'] - previous['keyframe_sequence'] >= INVENTORY_KEYFRAME_INTERVAL:
+        snapshot.update({'kind': 'keyframe', 'keyframe_sequence': snapshot['sequence'],
+                         'items': list(new_items.values())})
+    else:
+        delta = diff_inventory_items(load_snapshot_items(client, previous, db_name), new_items)
+        snapshot.update({'kind': 'delta', 'keyframe_sequence': previous['keyframe_sequence'], **delta})
+
+    snapshots.insert_one(snapshot)
+    print(f"Inventory snapshot {snapshot['sequence']} saved as a {snapshot['kind']}.")
+    return snapshot
+
+
+def get_latest_snapshot_of(client, inventory_id, db_name='mydatabase'):
+    """
+    Returns the newest snapshot recorded for an inventory document, without its items.
+    """
+    return client[db_name][SNAPSHOTS_COLLECTION].find_one(
+        {'inventory_id': inventory_id}, sort=[('sequence', DESCENDING)],
+        projection={'sequence': 1, 'keyframe_sequence': 1, 'taken_at': 1}
+    )
+
+
+def get_inventory_as_of(client, moment, db_name='mydatabase'):
+    """
+    Reconstructs the inventory that was current at a point in time (naive UTC).
+
+    :return: Dict with 'taken_at' and 'items', or None if no snapshot is that old.
+    """
+    snapshot = client[db_name][SNAPSHOTS_COLLECTION].find_one(
+        {'taken_at': {'$lte': moment}}, sort=[('taken_at', DESCENDING), ('sequence', DESCENDING)],
+        projection={'sequence': 1, 'keyframe_sequence': 1, 'taken_at': 1}
+    )
+    if snapshot is None:
+        return None
+    return {'taken_at': snapshot['taken_at'], 'items': list(load_snapshot_items(client, snapshot, db_name).values())}
+
+
+def diff_inventory_snapshots(client, since, until, db_name='mydatabase'):
+    """
+    Compares the inventories current at two points in time.
+
+    :return: Dict with 'added' and 'removed' items and 'changed' (before, after) pairs,
+             or None if there is no snapshot as of `since`.
+    """
+    before = get_inventory_as_of(client, since, db_name)
+    after = get_inventory_as_of(client, until, db_name)
+    if before is None or after is None:
+        return None
+
+    old_items, new_items = index_items(before['items']), index_items(after['items'])
+    return {
+        'added': [item for item_number, item in new_items.items() if item_number not in old_items],
+        'removed': [item for item_number, item in old_items.items() if item_number not in new_items],
+        'changed': [(old_items[item_number], item) for item_number, item in new_items.items()
+                    if item_number in old_items and old_items[item_number] != item],
+    }
+
+
+def snapshot_existing_inventories(client, db_name='mydatabase'):
+    """
+    Snapshots the inventory documents that have no snapshot yet, oldest first.
+
+    Run once to seed the snapshots from the existing full documents; later runs
+    pick up inventories saved without a snapshot, such as those inserted by
+    replay_archive with past-dated _ids. Sequence order then differs from time
+    order, which is fine: every snapshot reconstructs to exactly its own items,
+    and get_inventory_as_of picks snapshots by taken_at.
+
+    :return: Number of snapshots written.
+    """
+    snapshotted_ids = client[db_name][SNAPSHOTS_COLLECTION].distinct('inventory_id', {'inventory_id': {'$ne': None}})
+    query = {'items.0': {'$exists': True}, '_id': {'$nin': snapshotted_ids}}
+
+    count = 0
+    for inventory in client[db_name]['inventory'].find(query).sort('_id', ASCENDING):
+        record_inventory_snapshot(client, inventory, inventory['_id'],
+                                  inventory['_id'].generation_time.replace(tzinfo=None), db_name)
+        count += 1
+    return count
+
+
+def compact_inventory_documents(client, keep, db_name='mydatabase'):
+    """
+    Drops the items of full inventory documents older than the newest `keep`.
+
+    Only documents already captured in a snapshot are compacted; they keep their
+    _id and pdf_sha256, so duplicate detection and the latest-inventory lookups
+    are unaffected.
+
+    :return: Number of documents compacted.
+    """
+    inventory_collection = client[db_name]['inventory']
+    recent = inventory_collection.find({}, {'_id': 1}).sort('_id', DESCENDING).limit(keep)
+    recent_ids = [document['_id'] for document in recent]
+    snapshotted_ids = client[db_name][SNAPSHOTS_COLLECTION].distinct('inventory_id', {'inventory_id': {'$ne': None}})
+
+    result = inventory_collection.update_many(
+        {'_id': {'$in': snapshotted_ids, '$nin': recent_ids}, 'items': {'$exists': True}},
+        {'$unset': {'items': ''}, '$set': {'compacted': True}}
+    )
+    return result.modified_count
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Seconds a cached ordering map is trusted even if the catalog version did not change
+ITEM_ORDERING_TTL = int(os.getenv('ITEM_ORDERING_TTL', '300'))
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def fetch_item_ordering(client, db_name='mydatabase', collection_name='items'):
+    """
+    Builds the ItemNumber -> Orderby map straight from the items collection.
+
+    Items without a usable Orderby sort last.
+
+    :return: The map, or None if the catalog could not be read.
+    """
+    db = client[db_name]
+    collection = db[collection_name]
+    items_ordering = {}
+    try:
+        cursor = collection.find({}, {'_id': 0, 'ItemNumber': 1, 'Orderby': 1})
+        for item in cursor:
+            item_number = str(item.get('ItemNumber'))
+            try:
+                order = int(float(item.get('Orderby')))
+            except (TypeError, ValueError, OverflowError):
+                order = float('inf')  # Use a large number for items without an ordering index
+            items_ordering[item_number] = order
+    except Exception as e:
+        print(f"Failed to fetch item ordering: {e}")
+        return None
+    return items_ordering
+
+
+def get_catalog_version(client, db_name='mydatabase', status_collection='status'):
+    status_document = client[db_name][status_collection].find_one({'variable': 'catalog_version'}, {'value': 1})
+    return status_document.get('value', 0) if status_document else 0
+
+
+def get_item_ordering(client, db_name='mydatabase', collection_name='items'):
+    """
+    Returns the item ordering map, cached per process.
+
+    The cache is keyed on the catalog version stored in status.catalog_version,
+    so checking it costs one small lookup instead of reading the whole catalog.
+    Entries also expire after ITEM_ORDERING_TTL seconds, which covers catalog
+    changes made without bumping the version.
+    """
+    version = get_catalog_version(client, db_name)
+    key = (db_name, collection_name)
+
+    with _cache_lock:
+        cached = _cache.get(key)
+    if cached and cached['version'] == version and time.monotonic() - cached['loaded_at'] < ITEM_ORDERING_TTL:
+        return cached['ordering']
+
+    items_ordering = fetch_item_ordering(client, db_name, collection_name)
+    if items_ordering is None:
+        # A failed load is not cached; fall back to the last good map until the next call
+        return cached['ordering'] if cached else {}
+    with _cache_lock:
+        _cache[key] = {'version': version, 'loaded_at': time.monotonic(), 'ordering': items_ordering}
+    return items_ordering
+
+
+def invalidate_item_ordering(client, db_name='mydatabase', status_collection='status'):
+    """
+    Marks the catalog as changed; call this after updating the items collection.
+
+    Bumping the version invalidates the cached map in every process, not just this one.
+    """
+    client[db_name][status_collection].update_one(
+        {'variable': 'catalog_version'}, {'$inc': {'value': 1}}, upsert=True
+    )
+    with _cache_lock:
+        _cache.clear()
+
+
+def refresh_catalog_version(client, db_name='mydatabase', collection_name='items', status_collection='status'):
+    """
+    Bumps the catalog version if the item ordering changed since the last check.
+
+    The items collection is maintained outside this app, so nothing here writes
+    to it and calls invalidate_item_ordering. This compares a fingerprint of the
+    ordering instead and runs periodically (operations.tasks). Anything that
+    updates items can still call invalidate_item_ordering directly.
+
+    :return: True if the version was bumped.
+    """
+    items_ordering = fetch_item_ordering(client, db_name, collection_name)
+    if items_ordering is None:
+        return False
+    fingerprint = hashlib.sha256(json.dumps(items_ordering, sort_keys=True).encode()).hexdigest()
+
+    status = client[db_name][status_collection]
+    stored = status.find_one({'variable': 'catalog_fingerprint'}, {'value': 1})
+    if stored and stored.get('value') == fingerprint:
+        return False
+    status.update_one({'variable': 'catalog_fingerprint'}, {'$set': {'value': fingerprint}}, upsert=True)
+    invalidate_item_ordering(client, db_name, status_collection)
+    print("Item catalog changed, ordering cache invalidated.")
+    return True
+
+
+def reorder_items(items, items_ordering):
+    # Sort items based on the order provided in items_ordering
+    items.sort(key=lambda x: items_ordering.get(x['ItemNumber'], float('inf')))
+    return items
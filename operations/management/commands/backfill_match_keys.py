@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from dotenv import load_dotenv
+
+from operations.mongodb_utils import get_client, close_client
+from operations.transfers import backfill_match_keys
+
+
+class Command(BaseCommand):
+    help = "Sets the transfer match_key on existing orders and transfers so verification can look them up by equality."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        load_dotenv()
+        client = get_client()
+        try:
+            updated = backfill_match_keys(client, 'mydatabase', options['batch_size'])
+        finally:
+            close_client()
+        for collection, count in updated.items():
+            self.stdout.write(f"{collection}: {count} documents updated")
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from pymongo import MongoClient
+
+from operations.benchmarks import BENCHMARK_DB, mongomock_client, run_ingestion_benchmark
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks order ingestion against a synthetic mailbox served in-process, "
+            "reporting per-stage throughput and p50/p95 latency.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--emails', type=int, default=200, help="Number of route order emails to generate.")
+        parser.add_argument('--min-items', type=int, default=10)
+        parser.add_argument('--max-items', type=int, default=300)
+        parser.add_argument('--forwarded-ratio', type=float, default=0.2,
+                            help="Share of orders sent as forwarded copies.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--mongo-uri', default=None,
+                            help=f"Local mongod to write to (database {BENCHMARK_DB}, dropped afterwards). "
+                                 "Uses mongomock when omitted.")
+
+    def handle(self, *args, **options):
+        if options['mongo_uri']:
+            client = MongoClient(options['mongo_uri'])
+        else:
+            try:
+                client = mongomock_client()
+            except ImportError:
+                raise CommandError("Install mongomock or pass --mongo-uri pointing at a local mongod.")
+
+        try:
+            timer, mail = run_ingestion_benchmark(client, options['emails'], options['min_items'],
+                                                  options['max_items'], options['forwarded_ratio'], options['seed'])
+        finally:
+            client.close()
+
+        self.stdout.write(f"{'stage':<30}{'calls':>7}{'total s':>10}{'calls/s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+        for stage, calls, total, throughput, p50, p95 in timer.report():
+            self.stdout.write(f"{stage:<30}{calls:>7}{total:>10.3f}{throughput:>10.1f}{p50:>10.2f}{p95:>10.2f}")
+        self.stdout.write(f"IMAP: {mail.round_trips} round trips, {mail.bytes_sent / 1024:.0f} KiB sent "
+                          f"for {len(mail.messages)} messages")
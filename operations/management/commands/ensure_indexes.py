@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from dotenv import load_dotenv
+
+from operations.mongodb_utils import get_client, close_client
+from operations.Inventory_Backend import ensure_oos_indexes
+from operations.indexes import ensure_indexes, explain_hot_queries, get_index_report
+
+
+class Command(BaseCommand):
+    help = ("Creates the MongoDB indexes declared in operations.indexes, then reports missing, "
+            "undeclared and unused indexes and the plan each hot query uses.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--report-only', action='store_true',
+                            help="Only print the report, without creating anything.")
+        parser.add_argument('--db', default='mydatabase')
+
+    def handle(self, *args, **options):
+        load_dotenv()
+        client = get_client()
+        db_name = options['db']
+
+        try:
+            if not options['report_only']:
+                # Drops the duplicate ItemNumbers that would make the unique index fail
+                ensure_oos_indexes(client, db_name)
+                for collection, error in ensure_indexes(client, db_name).items():
+                    self.stderr.write(f"{collection}: {error}")
+
+            for collection, report in get_index_report(client, db_name).items():
+                for status in ('missing', 'undeclared', 'unused'):
+                    if report[status]:
+                        self.stdout.write(f"{collection}: {status} {', '.join(report[status])}")
+
+            for collection, query, sort, plan in explain_hot_queries(client, db_name):
+                flag = '  <-- collection scan' if plan == 'COLLSCAN' else ''
+                self.stdout.write(f"{collection} {query} sort={sort}: {plan}{flag}")
+        finally:
+            close_client()
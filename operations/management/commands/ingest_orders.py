@@ -0,0 +1,33 @@
+import os
+
+from django.core.management.base import BaseCommand
+from dotenv import load_dotenv
+
+from operations.mongodb_utils import get_client, close_client
+from operations.Order_Backend import ensure_order_indexes, watch_order_inbox
+
+
+class Command(BaseCommand):
+    help = "Ingests route order emails as they arrive, holding one IMAP IDLE session open."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--idle-timeout', type=int, default=None,
+                            help="Seconds to IDLE before re-polling (default: IMAP_IDLE_TIMEOUT).")
+        parser.add_argument('--max-backoff', type=int, default=300,
+                            help="Upper bound in seconds for the reconnect backoff.")
+
+    def handle(self, *args, **options):
+        load_dotenv()
+
+        email = os.getenv('EMAIL_ADDRESS')
+        password = os.getenv('EMAIL_PASSWORD')
+        client = get_client()
+
+        ensure_order_indexes(client, 'mydatabase', 'orders')
+        try:
+            watch_order_inbox(email, password, client, 'mydatabase', 'orders',
+                              idle_timeout=options['idle_timeout'], max_backoff=options['max_backoff'])
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping order ingestion.")
+        finally:
+            close_client()
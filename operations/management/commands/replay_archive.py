@@ -0,0 +1,49 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from dotenv import load_dotenv
+
+from operations.mongodb_utils import get_client, close_client
+from operations.raw_archive import ORDER_EMAIL, INVENTORY_PDF
+from operations.replay import replay_archive
+
+KINDS = {'orders': ORDER_EMAIL, 'inventory': INVENTORY_PDF}
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError(f"Invalid date {value!r}, expected YYYY-MM-DD.")
+
+
+class Command(BaseCommand):
+    help = ("Re-parses archived order emails or inventory PDFs received in a date range "
+            "with the current parsers and upserts the results.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(KINDS))
+        parser.add_argument('--since', type=parse_date, default=None, help="First day to replay (YYYY-MM-DD).")
+        parser.add_argument('--until', type=parse_date, default=None,
+                            help="Day to stop before (YYYY-MM-DD, exclusive).")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Parser processes (default: one per CPU).")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Archived files parsed and upserted per round (default: REPLAY_BATCH_SIZE).")
+        parser.add_argument('--status', default='Complete',
+                            help="Status for orders the replay inserts because they were missing.")
+        parser.add_argument('--overwrite', action='store_true',
+                            help="Also refresh the parsed fields of existing orders that were not edited by hand. "
+                                 "Without it, existing orders are left untouched.")
+
+    def handle(self, *args, **options):
+        load_dotenv()
+        client = get_client()
+        try:
+            counts = replay_archive(client, KINDS[options['kind']], options['since'], options['until'],
+                                    options['workers'], options['batch_size'], options['status'], options['overwrite'])
+        finally:
+            close_client()
+
+        self.stdout.write(f"Replayed {counts['replayed']} files: {counts['upserted']} inserted, "
+                          f"{counts['modified']} updated, {counts['skipped']} without items.")
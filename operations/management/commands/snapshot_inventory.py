@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from dotenv import load_dotenv
+
+from operations.mongodb_utils import get_client, close_client
+from operations.inventory_series import ensure_inventory_series, backfill_inventory_levels
+from operations.inventory_snapshots import ensure_snapshot_indexes, snapshot_existing_inventories, \
+    compact_inventory_documents
+
+
+class Command(BaseCommand):
+    help = ("Adds inventory documents missing from the delta snapshots and the per-item level series, "
+            "and optionally drops the items of old full inventory documents.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--compact-keep', type=int, default=None,
+                            help="Keep items on only this many of the newest inventory documents.")
+
+    def handle(self, *args, **options):
+        if options['compact_keep'] is not None and options['compact_keep'] < 1:
+            raise CommandError("--compact-keep must be at least 1; the latest inventory is read in full.")
+
+        load_dotenv()
+        client = get_client()
+        try:
+            ensure_snapshot_indexes(client)
+            count = snapshot_existing_inventories(client)
+            self.stdout.write(f"Snapshotted {count} inventories.")
+            ensure_inventory_series(client)
+            count = backfill_inventory_levels(client)
+            self.stdout.write(f"Added {count} inventories to the level series.")
+            if options['compact_keep'] is not None:
+                compacted = compact_inventory_documents(client, options['compact_keep'])
+                self.stdout.write(f"Compacted {compacted} inventory documents.")
+        finally:
+            close_client()
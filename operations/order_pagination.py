@@ -0,0 +1,72 @@
+import os
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+ORDERS_PAGE_SIZE = int(os.getenv('ORDERS_PAGE_SIZE', '15'))
+
+# The list only shows the order summary; the items arrays are the bulk of each document
+ORDER_LIST_PROJECTION = {'items': 0}
+
+
+class OrderPage:
+    """
+    One page of the orders list. Iterates over its orders and carries the cursors
+    for the neighbouring pages.
+    """
+
+    def __init__(self, orders, has_next, has_previous):
+        self.orders = orders
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = orders[-1]['order_id'] if has_next and orders else None
+        self.previous_cursor = orders[0]['order_id'] if has_previous and orders else None
+
+    def __iter__(self):
+        return iter(self.orders)
+
+    def __len__(self):
+        return len(self.orders)
+
+
+def parse_cursor(cursor):
+    try:
+        return ObjectId(cursor) if cursor else None
+    except (InvalidId, TypeError):
+        return None
+
+
+def get_order_page(collection, query, after=None, before=None, page_size=ORDERS_PAGE_SIZE):
+    """
+    Fetches one page of orders, newest first, without counting or skipping.
+
+    Pages are addressed by the _id of an order on the neighbouring page, so each
+    page is a single indexed range scan (see the orders indexes in operations.indexes)
+    no matter how far back it is.
+
+    :param query: Filter built by build_order_query.
+    :param after: order_id of the last order on the previous (newer) page.
+    :param before: order_id of the first order on the next (older) page.
+    :return: OrderPage.
+    """
+    after, before = parse_cursor(after), parse_cursor(before)
+
+    if before:
+        # Walk towards newer orders, then flip back to newest first
+        cursor = collection.find({**query, '_id': {'$gt': before}}, ORDER_LIST_PROJECTION).sort('_id', ASCENDING)
+        orders = list(cursor.limit(page_size + 1))
+        has_previous = len(orders) > page_size
+        orders = orders[:page_size][::-1]
+        has_next = bool(orders)
+    else:
+        page_query = {**query, '_id': {'$lt': after}} if after else query
+        cursor = collection.find(page_query, ORDER_LIST_PROJECTION).sort('_id', DESCENDING)
+        orders = list(cursor.limit(page_size + 1))
+        has_next = len(orders) > page_size
+        orders = orders[:page_size]
+        has_previous = after is not None
+
+    for order in orders:
+        order['order_id'] = str(order['_id'])
+    return OrderPage(orders, has_next, has_previous)
@@ -0,0 +1,389 @@
+import hashlib
+import io
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from bson.binary import Binary
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+
+from operations.item_ordering import get_item_ordering, reorder_items
+
+# Seconds a rendered PDF (and its ETag) stays valid, as a backstop for data changes
+# that no version below has picked up yet
+ORDER_PDF_TTL = int(os.getenv('ORDER_PDF_TTL', '3600'))
+
+ORDER_PDFS_COLLECTION = 'order_pdfs'
+
+# Order fields drawn on the pick sheet; changes to anything else (status, times) keep the cached PDF
+ORDER_PDF_FIELDS = ('route', 'pick_up_date', 'transfer_id', 'builder_name', 'items')
+ORDER_PDF_PROJECTION = {field: 1 for field in ORDER_PDF_FIELDS}
+
+# status variables for the other data on the pick sheet, bumped when that data changes:
+# oos_version by inventory_main, catalog_version by refresh_catalog_version (or
+# invalidate_item_ordering), and mapped_items_version by refresh_mapped_items_version
+DATA_VERSION_VARIABLES = ('oos_version', 'mapped_items_version', 'catalog_version')
+
+# Orders whose pick sheets are pre-rendered
+OPEN_ORDER_STATUSES = ('Pending', 'Preparing')
+
+SHIP_TO_ROUTES = [
+    "RTC000003", "RTC00013", "RTC000018", "RTC000019", "RTC000089",
+    "RTC000377", "RTC000379", "RTC000649", "RTC000700", "RTC000719"
+]
+
+
+def get_data_versions(client, db_name='mydatabase', status_collection='status'):
+    """
+    Reads the versions of the non-order data on the pick sheet in one query.
+    """
+    documents = client[db_name][status_collection].find(
+        {'variable': {'$in': list(DATA_VERSION_VARIABLES)}}, {'_id': 0, 'variable': 1, 'value': 1}
+    )
+    versions = {variable: 0 for variable in DATA_VERSION_VARIABLES}
+    versions.update({document['variable']: document.get('value', 0) for document in documents})
+    return versions
+
+
+def bump_data_version(client, variable, db_name='mydatabase', status_collection='status'):
+    """
+    Marks pick-sheet data as changed, so every cached order PDF goes stale.
+    """
+    client[db_name][status_collection].update_one({'variable': variable}, {'$inc': {'value': 1}}, upsert=True)
+
+
+def refresh_mapped_items_version(client, db_name='mydatabase', status_collection='status'):
+    """
+    Bumps mapped_items_version if the item locations or types changed since the last check.
+
+    mapped_items is maintained outside this app, so its changes are found by
+    fingerprinting the fields drawn on the pick sheet. Run periodically with the
+    background rendering (operations.tasks).
+
+    :return: True if the version was bumped.
+    """
+    documents = client[db_name]['mapped_items'].find({}, {'_id': 0, 'ItemNumber': 1, 'Location': 1, 'Type': 1})
+    mapped_items = sorted(json.dumps(document, sort_keys=True, default=str) for document in documents)
+    fingerprint = hashlib.sha256('\n'.join(mapped_items).encode()).hexdigest()
+
+    status = client[db_name][status_collection]
+    stored = status.find_one({'variable': 'mapped_items_fingerprint'}, {'value': 1})
+    if stored and stored.get('value') == fingerprint:
+        return False
+    status.update_one({'variable': 'mapped_items_fingerprint'}, {'$set': {'value': fingerprint}}, upsert=True)
+    bump_data_version(client, 'mapped_items_version', db_name, status_collection)
+    return True
+
+
+def order_pdf_etag(order, versions, now=None):
+    """
+    Builds the ETag of an order's pick sheet from its drawn fields and the data versions.
+
+    The ETag also carries the current ORDER_PDF_TTL period, so browsers revalidating
+    with If-None-Match get a fresh sheet at least once per period.
+    """
+    period = int((now or time.time()) // ORDER_PDF_TTL)
+    payload = json.dumps({'order': {field: order.get(field) for field in ORDER_PDF_FIELDS}, 'versions': versions,
+                          'period': period}, sort_keys=True, default=str)
+    return f'"{hashlib.sha256(payload.encode()).hexdigest()}"'
+
+
+def is_fresh_pdf(stored, etag):
+    """
+    Whether a stored order_pdfs document can be served for the ETag.
+    """
+    return (stored is not None and stored.get('etag') == etag
+            and stored.get('rendered_at', datetime.min) >= datetime.now() - timedelta(seconds=ORDER_PDF_TTL))
+
+
+def load_pick_sheet_data(client, db_name='mydatabase'):
+    """
+    Reads the OOS items and the item locations and types shared by every pick sheet.
+
+    :return: Tuple of (set of OOS ItemNumbers, ItemNumber -> location, ItemNumber -> type).
+    """
+    db = client[db_name]
+    oos_items = {doc["ItemNumber"] for doc in db['oos_items'].find({}, {'ItemNumber': 1})}
+
+    item_to_location = {}
+    item_to_type = {}
+    for doc in db['mapped_items'].find({}, {'ItemNumber': 1, 'Location': 1, 'Type': 1}):
+        item_number = doc["ItemNumber"]
+        item_to_location[item_number] = doc.get("Location", "N/A")
+        item_to_type[item_number] = doc.get("Type", "N/A")
+    return oos_items, item_to_location, item_to_type
+
+
+def draw_order_pdf(order, ordered_items, oos_items, item_to_location, item_to_type):
+    """
+    Draws the pick sheet of an order.
+
+    :param ordered_items: The order's items, in pick order.
+    :return: The PDF bytes.
+    """
+    buffer = io.BytesIO()
+    p = canvas.Canvas(buffer, pagesize=letter)
+    width, height = letter
+
+    # Initialize totals
+    total_quantity = 0
+    adjusted_total_quantity = 0
+    type_counts = {}
+
+    for item in ordered_items:
+        item_number = item.get('ItemNumber', '')
+        try:
+            quantity = int(item.get('Quantity', 0))
+            total_quantity += quantity  # Add to total quantity
+            if item_number not in oos_items:
+                adjusted_total_quantity += quantity  # Add to adjusted total if not OOS
+
+            # Fetch item type using the item number, default to "Other" if not found
+            item_type = item_to_type.get(item_number, "Other")
+            # Extract the type key assuming it starts with letters followed by numbers (e.g., 'PG10')
+
+            # Calculate type-specific statistics
+            if item_type != "Other":
+                if item_type in type_counts:
+                    type_counts[item_type] += quantity
+                else:
+                    type_counts[item_type] = quantity
+        except ValueError:
+            # Log error or handle the case where the quantity is not an integer
+            print(f"Warning: Invalid quantity '{item.get('Quantity')}' for item number {item_number}")
+
+    p.setFont("Helvetica-Bold", 12)
+    pick_up_date = order.get('pick_up_date')
+    formatted_date = pick_up_date.strftime('%B %d, %Y') if pick_up_date else 'N/A'
+    p.drawString(30, height - 30, f"Date: {formatted_date}")
+
+    # Set font to Helvetica-Bold for headers
+    tid = order.get("transfer_id")
+    p.setFont("Helvetica-Bold", 12)
+    route_number = order.get('route', 'N/A')
+    route_type = "Ship-to" if route_number in SHIP_TO_ROUTES else "Pick-up"
+    p.drawString(30, height - 50, f"Route Number: {route_number} ({route_type}) ")
+    p.setFont("Helvetica", 12)
+
+    builder_name = order.get("builder_name")
+    p.drawString(30, height - 70, f"Transfer ID: {tid} ")
+    p.drawString(30, height - 90, f"Builder: {builder_name} ")
+
+    # Move total quantity and related information to the top right
+    p.drawString(width - 300, height - 50, f"Total Quantity Ordered: {total_quantity}")
+    p.drawString(width - 300, height - 70, f"Total After OOS Adjustments: {adjusted_total_quantity}")
+    p.drawString(width - 300, height - 90, "Build Adjustments:")
+    p.rect(width - 180, height - 92, 50, 15)  # Adjustment input box
+    p.drawString(width - 300, height - 110, "Build Count:")
+    p.rect(width - 180, height - 112, 50, 15)  # Build count box
+    p.drawString(width - 300, height - 130, "Scan Count:")
+    p.rect(width - 180, height - 132, 50, 15)  # Scan count box
+
+    # Starting position adjustment for item list
+    y_position = height - 170
+
+    p.setFont("Helvetica-Bold", 12)
+    # Draw column headers, including a new column for 'Location'
+    p.drawString(30, y_position, "Item Number")
+    p.drawString(150, y_position, "Description")
+    p.drawString(340, y_position, "Quantity")
+    # Adjust existing columns to make room for the new 'Location' column
+    p.drawString(420, y_position, "Type")  # New location column
+    p.drawString(470, y_position, "Location")  # New location column
+    p.drawString(530, y_position, "Stock Status")
+    p.drawString(630, y_position, "Check")  # Checkboxes moved to the far right
+
+    # Revert to normal font for item details
+    p.setFont("Helvetica", 12)
+
+    # Adjust y_position for first item row
+    y_position -= 20
+
+    for item in ordered_items:
+        quantity = item.get('Quantity', 0)
+
+        # Skip items with no quantity or quantity set to 0
+        if not quantity:
+            continue
+
+        # Draw a line to separate this item from the next
+        p.line(30, y_position - 2, 580, y_position - 2)  # Adjust line length as needed
+
+        item_number = item.get('ItemNumber', 'Unknown')
+        description = item.get('ItemDescription', 'N/A')
+        stock_status = "IS" if item_number not in oos_items else "OOS"
+
+        # Drawing item details (keep this part unchanged)
+        p.drawString(30, y_position, str(item_number))
+        p.drawString(150, y_position, description)
+        p.drawString(350, y_position, str(quantity))
+
+        # If the item is out of stock, cross out the quantity
+        if stock_status == "OOS":
+            # Calculate width of the quantity text for precise line drawing
+            quantity_text_width = p.stringWidth(str(quantity), "Helvetica", 12)
+            # Draw a line through the quantity text
+            p.line(350, y_position + 4, 350 + quantity_text_width, y_position + 4)
+
+        item_type = item_to_type.get(item_number, "N/A")  # Fetch the type
+        p.drawString(420, y_position, item_type)
+
+        # Draw the location next to each item
+        item_location = item_to_location.get(item_number, "N/A")
+        p.drawString(485, y_position, item_location)
+
+        # Draw the placeholder box for adjustment quantity, stock status, and checkbox
+        p.rect(370, y_position - 2, 30, 15)  # Placeholder box for adjustment quantity
+        p.drawString(530, y_position, stock_status)  # Include stock status
+        p.rect(630, y_position - 2, 12, 12, stroke=1, fill=0)  # Checkbox
+
+        # Move to the next line
+        y_position -= 20
+
+        # Check if we need to start a new page
+        if y_position < 50:
+            p.showPage()
+            y_position = height - 50
+
+    # Define the start position for the statistics section on the page
+    y_position = max(50, y_position - 20)  # Ensure there's space or create a new page if needed
+    x_position_start = 30  # Start at the left margin
+    x_increment = 100  # Increment x position for each statistic, adjust as necessary based on your page width
+
+    # Calculate the starting y position for the statistics, ensuring there's space for headers and counts
+    y_position = max(50, y_position - 40)  # Move up from the last item or set at a minimum if near page end
+    x_position_start = 30  # Start at the left margin of the page
+    total_types = len(type_counts)
+
+    # Calculate even spacing across the page, orders with no typed items have no columns
+    space_between = (width - 20) / total_types if total_types else 0  # Subtract margins and divide by number of types
+
+    # Set initial x position
+    x_position = x_position_start
+
+    if route_number in SHIP_TO_ROUTES:
+        # Draw bold column headers for each item type
+        p.setFont("Helvetica-Bold", 12)  # Set font to bold for headers
+        for type_key in type_counts.keys():
+            p.drawString(x_position, y_position, type_key)
+            x_position += space_between  # Move to next column position
+
+        # Move down to place counts under headers
+        y_position -= 20
+        x_position = x_position_start  # Reset to start position
+
+        # Draw counts under each header
+        p.setFont("Helvetica", 12)  # Set font to normal for counts
+        for type_key, count in type_counts.items():
+            # Determine the divisor for the type
+            divisor = 1  # Default divisor
+            if type_key in ['PG10', 'PW10', 'SG12', 'SW12', 'SW18', ]:
+                divisor = 25
+            elif type_key in ['PG18', 'K10', 'K22', 'IW', 'PW18']:
+                divisor = 20
+            elif type_key == 'PC':
+                divisor = 19
+            elif type_key == 'MLT':
+                divisor = 23
+            elif type_key == 'K32':
+                divisor = 15
+            elif type_key == 'K48':
+                divisor = 10
+
+            # Calculate and format the adjusted count
+            formatted_count = round(count / divisor, 1)
+            p.drawString(x_position, y_position, str(formatted_count) + " ")
+            x_position += space_between  # Move to next column position
+
+    p.setTitle(route_number)
+    p.showPage()
+    p.save()
+    return buffer.getvalue()
+
+
+def render_order_pdf(client, order, versions=None, pick_sheet_data=None, db_name='mydatabase'):
+    """
+    Renders an order's pick sheet and stores it in order_pdfs under its ETag.
+
+    :param order: The order document, with at least the ORDER_PDF_FIELDS.
+    :param versions: Data versions from get_data_versions, read if not given.
+    :param pick_sheet_data: Result of load_pick_sheet_data, read if not given.
+    :return: The PDF bytes.
+    """
+    versions = versions or get_data_versions(client, db_name)
+    # The ETag is taken before reorder_items sorts the items in place
+    etag = order_pdf_etag(order, versions)
+    oos_items, item_to_location, item_to_type = pick_sheet_data or load_pick_sheet_data(client, db_name)
+
+    items_ordering = get_item_ordering(client, db_name, 'items')
+    ordered_items = reorder_items(list(order.get('items', [])), items_ordering)
+    pdf = draw_order_pdf(order, ordered_items, oos_items, item_to_location, item_to_type)
+
+    client[db_name][ORDER_PDFS_COLLECTION].update_one(
+        {'_id': order['_id']},
+        {'$set': {'etag': etag, 'pdf': Binary(pdf), 'rendered_at': datetime.now()}},
+        upsert=True
+    )
+    return pdf
+
+
+def get_cached_order_pdf(client, order_id, etag, db_name='mydatabase'):
+    """
+    Returns the stored PDF of an order if it matches the ETag and is within ORDER_PDF_TTL, else None.
+    """
+    stored = client[db_name][ORDER_PDFS_COLLECTION].find_one({'_id': order_id, 'etag': etag},
+                                                            {'pdf': 1, 'etag': 1, 'rendered_at': 1})
+    return stored if is_fresh_pdf(stored, etag) else None
+
+
+def render_open_order_pdfs(client, db_name='mydatabase'):
+    """
+    Renders the pick sheets of open orders whose stored PDF is missing or stale.
+
+    The OOS and mapped_items data is read once for all of them.
+
+    An order that fails to render is logged and skipped.
+
+    :return: Number of PDFs rendered.
+    """
+    db = client[db_name]
+    versions = get_data_versions(client, db_name)
+    orders = list(db['orders'].find({'status': {'$in': list(OPEN_ORDER_STATUSES)}}, ORDER_PDF_PROJECTION))
+    stored = {document['_id']: document for document in db[ORDER_PDFS_COLLECTION].find(
+        {'_id': {'$in': [order['_id'] for order in orders]}}, {'etag': 1, 'rendered_at': 1})}
+
+    # Stale if the data changed or the PDF is older than ORDER_PDF_TTL, which the view would not serve
+    stale = [order for order in orders if not is_fresh_pdf(stored.get(order['_id']), order_pdf_etag(order, versions))]
+    if not stale:
+        return 0
+
+    pick_sheet_data = load_pick_sheet_data(client, db_name)
+    rendered = 0
+    for order in stale:
+        # One broken order must not keep the rest from being pre-rendered
+        try:
+            render_order_pdf(client, order, versions, pick_sheet_data, db_name)
+            rendered += 1
+        except Exception as e:
+            print(f"Failed to render the PDF of order {order['_id']}: {e}")
+    print(f"Rendered {rendered} of {len(stale)} stale order PDFs.")
+    return rendered
+
+
+def queue_order_pdf_render(order_id=None):
+    """
+    Queues a background render of one order's pick sheet, or of every open order's.
+
+    Failing to queue is not an error: generate_order_pdf renders on demand.
+    """
+    # Imported here, the tasks module imports this one
+    from operations.tasks import render_order_pdf_task, render_open_order_pdfs_task
+    try:
+        if order_id is None:
+            render_open_order_pdfs_task.delay()
+        else:
+            render_order_pdf_task.delay(str(order_id))
+    except Exception as e:
+        print(f"Could not queue order PDF rendering: {e}")
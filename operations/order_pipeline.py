@@ -0,0 +1,192 @@
+import asyncio
+import os
+from collections import deque
+from email import policy
+from email.parser import BytesParser
+
+from gridfs.errors import FileExists
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo.errors import BulkWriteError
+
+from operations.Order_Backend import build_order_document, collect_insert_failures, find_route_order_uids, \
+    parse_email_content, search_new_email_uids, uid_watermark_updates, cap_uid_watermark
+from operations.imap_utils import IMAP_FETCH_CHUNK_SIZE, connect_imap, select_mailbox, search_uids, \
+    fetch_messages, close_imap
+from operations.mongodb_utils import get_client_options
+from operations.raw_archive import ORDER_EMAIL, RAW_ARCHIVE_BUCKET, build_archive_file, get_received_at
+
+# Bounded queues between the stages; a full queue pauses the stage feeding it
+ORDER_PIPELINE_QUEUE_SIZE = int(os.getenv('ORDER_PIPELINE_QUEUE_SIZE', '100'))
+ORDER_PIPELINE_PARSERS = int(os.getenv('ORDER_PIPELINE_PARSERS', '4'))
+ORDER_PIPELINE_WRITE_BATCH = int(os.getenv('ORDER_PIPELINE_WRITE_BATCH', '50'))
+
+_DONE = object()
+
+
+async def fetch_stage(mail, order_uids, raw_queue, chunk_size=None):
+    """
+    Downloads order bodies chunk by chunk on a worker thread and queues (uid, raw_email).
+
+    The next chunk is requested while the parsers and writer work on the previous one.
+    """
+    chunk_size = chunk_size or IMAP_FETCH_CHUNK_SIZE
+    for start in range(0, len(order_uids), chunk_size):
+        chunk = order_uids[start:start + chunk_size]
+        messages = await asyncio.to_thread(lambda: list(fetch_messages(mail, chunk, chunk_size=chunk_size)))
+        for uid, raw_email in messages:
+            await raw_queue.put((uid, raw_email))
+
+
+async def parse_stage(db, raw_queue, parsed_queue):
+    """
+    Parses and archives queued emails into order documents until it receives the stop marker.
+    """
+    parser = BytesParser(policy=policy.default)
+    while True:
+        item = await raw_queue.get()
+        if item is _DONE:
+            return
+        uid, raw_email = item
+        email_message, extracted_data = await asyncio.to_thread(parse_order_email, parser, raw_email)
+        await archive_raw(db, raw_email, ORDER_EMAIL, get_received_at(email_message),
+                          message_id=extracted_data['message_id'])
+        await parsed_queue.put((uid, build_order_document(extracted_data)))
+
+
+def parse_order_email(parser, raw_email):
+    email_message = parser.parsebytes(raw_email)
+    return email_message, parse_email_content(email_message)
+
+
+async def archive_raw(db, data, kind, received_at, **metadata):
+    """
+    Async counterpart of raw_archive.archive_raw.
+    """
+    digest, filename, compressed, metadata = build_archive_file(data, kind, received_at, **metadata)
+    bucket = AsyncIOMotorGridFSBucket(db, bucket_name=RAW_ARCHIVE_BUCKET)
+    try:
+        await bucket.upload_from_stream_with_id(digest, filename, compressed, metadata=metadata)
+    except FileExists:
+        pass
+    return digest
+
+
+async def write_stage(db, orders_collection, parsed_queue, order_uids, uidvalidity, batch_size=None):
+    """
+    Writes parsed orders in batches and advances the UID watermark.
+
+    Parsers finish out of order, so the watermark only moves up to the highest
+    UID below which every order has been written. An order whose insert failed
+    is never counted as written, which holds the watermark below it.
+
+    :return: The order UIDs that were not written, in ascending order.
+    """
+    batch_size = batch_size or ORDER_PIPELINE_WRITE_BATCH
+    orders_col = db[orders_collection]
+    unwritten = deque(order_uids)
+    written = set()
+    batch = []
+
+    async def flush():
+        documents = [document for _, document in batch if document is not None]
+        failed_ids = set()
+        if documents:
+            try:
+                result = await orders_col.insert_many(documents, ordered=False)
+                inserted_count = len(result.inserted_ids)
+            except BulkWriteError as e:
+                inserted_count = e.details.get('nInserted', 0)
+                failed_ids = {document['_id'] for document, _ in collect_insert_failures(e, documents)}
+            print(f"Inserted {inserted_count} of {len(documents)} orders.")
+        written.update(uid for uid, document in batch if document is None or document['_id'] not in failed_ids)
+        batch.clear()
+
+        watermark = None
+        while unwritten and unwritten[0] in written:
+            watermark = unwritten.popleft()
+        if watermark is not None:
+            await save_uid_watermark(db, uidvalidity, watermark)
+
+    while True:
+        item = await parsed_queue.get()
+        if item is not _DONE:
+            batch.append(item)
+        if batch and (item is _DONE or len(batch) >= batch_size or parsed_queue.empty()):
+            await flush()
+        if item is _DONE:
+            return list(unwritten)
+
+
+async def save_uid_watermark(db, uidvalidity, last_uid, status_collection='status'):
+    collection = db[status_collection]
+    advance, reset = uid_watermark_updates(uidvalidity, last_uid)
+    result = await collection.update_one(*advance)
+    if result.matched_count == 0:
+        await collection.update_one(*reset, upsert=True)
+
+
+async def process_new_order_emails(mail, db, orders_collection='orders', mailbox='inbox'):
+    """
+    Async counterpart of Order_Backend.process_new_order_emails.
+
+    Fetching, parsing and writing run as concurrent stages joined by bounded queues.
+    """
+    uidvalidity = await asyncio.to_thread(select_mailbox, mail, mailbox)
+    status_document = await db['status'].find_one({'variable': 'last_parsed'}) or {}
+    last_uid = status_document.get('value')
+    if last_uid is not None and status_document.get('uidvalidity') != uidvalidity:
+        print(f"UIDVALIDITY changed from {status_document.get('uidvalidity')} to {uidvalidity}, resetting watermark.")
+        last_uid = None
+
+    if last_uid is None:
+        highest_uid = max(await asyncio.to_thread(search_uids, mail, 'UID *'), default=0)
+    else:
+        highest_uid = last_uid
+
+    uids = await asyncio.to_thread(search_new_email_uids, mail, last_uid)
+    highest_uid = max([highest_uid] + uids)
+    order_uids = await asyncio.to_thread(find_route_order_uids, mail, uids)
+
+    raw_queue = asyncio.Queue(maxsize=ORDER_PIPELINE_QUEUE_SIZE)
+    parsed_queue = asyncio.Queue(maxsize=ORDER_PIPELINE_QUEUE_SIZE)
+
+    parsers = [asyncio.create_task(parse_stage(db, raw_queue, parsed_queue)) for _ in range(ORDER_PIPELINE_PARSERS)]
+    writer = asyncio.create_task(write_stage(db, orders_collection, parsed_queue, order_uids, uidvalidity))
+
+    async def feed():
+        await fetch_stage(mail, order_uids, raw_queue)
+        for _ in parsers:
+            await raw_queue.put(_DONE)
+        await asyncio.gather(*parsers)
+        await parsed_queue.put(_DONE)
+
+    tasks = [asyncio.create_task(feed())] + parsers + [writer]
+    try:
+        # Any failing stage aborts the run; the watermark only covers what was written
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    # Orders that were not written are fetched again by the next pass
+    watermark = cap_uid_watermark(highest_uid, writer.result())
+    if last_uid is None or watermark > last_uid:
+        await save_uid_watermark(db, uidvalidity, watermark)
+
+
+async def run_order_pipeline(email_address, password, db_uri, db_name='mydatabase', orders_collection='orders'):
+    """
+    Runs one ingestion pass through the asyncio pipeline.
+
+    A Motor client belongs to the event loop it was created on, so each pass
+    creates its own, with the same pool settings as get_client.
+    """
+    client = AsyncIOMotorClient(db_uri, **get_client_options())
+    try:
+        mail = await asyncio.to_thread(connect_imap, email_address, password)
+        try:
+            await process_new_order_emails(mail, client[db_name], orders_collection)
+        finally:
+            await asyncio.to_thread(close_imap, mail)
+    finally:
+        client.close()
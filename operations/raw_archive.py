@@ -0,0 +1,108 @@
+import calendar
+import hashlib
+import os
+import struct
+import zlib
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import gridfs
+from bson.objectid import ObjectId
+from gridfs.errors import FileExists
+
+# GridFS bucket holding the compressed raw emails and PDFs, keyed by the SHA-256 of the original bytes
+RAW_ARCHIVE_BUCKET = os.getenv('RAW_ARCHIVE_BUCKET', 'raw_archive')
+RAW_ARCHIVE_LEVEL = int(os.getenv('RAW_ARCHIVE_LEVEL', '6'))
+
+ORDER_EMAIL = 'order_email'
+INVENTORY_PDF = 'inventory_pdf'
+
+
+def get_archive_bucket(client, db_name='mydatabase'):
+    return gridfs.GridFSBucket(client[db_name], bucket_name=RAW_ARCHIVE_BUCKET)
+
+
+def archive_raw(client, data, kind, received_at=None, db_name='mydatabase', **metadata):
+    """
+    Stores raw bytes zlib-compressed in the archive bucket, once per distinct content.
+
+    The file _id is the SHA-256 of the uncompressed bytes, so archiving the same
+    email or PDF again is a no-op.
+
+    :param data: The raw email or PDF bytes.
+    :param kind: ORDER_EMAIL or INVENTORY_PDF.
+    :param received_at: When the content arrived; used to select replay ranges.
+    :return: The SHA-256 hex digest the content is stored under.
+    """
+    digest, filename, compressed, metadata = build_archive_file(data, kind, received_at, **metadata)
+    bucket = get_archive_bucket(client, db_name)
+    try:
+        bucket.upload_from_stream_with_id(digest, filename, compressed, metadata=metadata)
+    except FileExists:
+        pass
+    return digest
+
+
+def build_archive_file(data, kind, received_at=None, **metadata):
+    """
+    Works out how raw bytes are stored in the archive bucket.
+
+    :return: Tuple of (file _id, filename, compressed bytes, metadata).
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    metadata.update({
+        'kind': kind,
+        'received_at': received_at or datetime.now(),
+        'size': len(data),
+        'compression': 'zlib',
+    })
+    return digest, f'{kind}/{digest}', zlib.compress(data, RAW_ARCHIVE_LEVEL), metadata
+
+
+def load_raw(client, digest, db_name='mydatabase'):
+    return zlib.decompress(read_compressed(client, digest, db_name))
+
+
+def read_compressed(client, digest, db_name='mydatabase'):
+    return get_archive_bucket(client, db_name).open_download_stream(digest).read()
+
+
+def find_archived(client, kind, since=None, until=None, db_name='mydatabase'):
+    """
+    Lists archived files of one kind received in [since, until), oldest first.
+
+    :return: Cursor over the GridFS file documents.
+    """
+    query = {'metadata.kind': kind}
+    received_range = {}
+    if since:
+        received_range['$gte'] = since
+    if until:
+        received_range['$lt'] = until
+    if received_range:
+        query['metadata.received_at'] = received_range
+    return client[db_name][f'{RAW_ARCHIVE_BUCKET}.files'].find(query).sort('metadata.received_at', 1)
+
+
+def get_received_at(msg):
+    """
+    Returns the Date header of a parsed email as naive UTC, or now if it is missing or unreadable.
+    """
+    try:
+        received_at = parsedate_to_datetime(str(msg['Date']))
+    except (TypeError, ValueError):
+        return datetime.now()
+    if received_at.tzinfo is not None:
+        received_at = received_at.astimezone(timezone.utc).replace(tzinfo=None)
+    return received_at
+
+
+def object_id_at(moment):
+    """
+    Returns a new ObjectId whose timestamp is `moment`.
+
+    Backfilled documents get one so sorting by _id keeps them in their
+    historical place instead of ahead of the live data.
+    """
+    return ObjectId(struct.pack('>I', calendar.timegm(moment.utctimetuple())) + os.urandom(8))
+
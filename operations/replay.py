@@ -0,0 +1,148 @@
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from email import policy
+from email.parser import BytesParser
+
+from pymongo import UpdateOne
+
+from operations.Inventory_Backend import parse_inventory_pdf, save_inventory_to_mongodb, replace_inventory_items
+from operations.inventory_snapshots import INVENTORY_FULL_DOCUMENTS, compact_inventory_documents
+from operations.Order_Backend import build_order_document, parse_email_content
+from operations.raw_archive import ORDER_EMAIL, INVENTORY_PDF, find_archived, read_compressed, object_id_at
+from operations.transfers import transfer_match_key
+
+# Archived files handed to the process pool (and upserted) per round
+REPLAY_BATCH_SIZE = int(os.getenv('REPLAY_BATCH_SIZE', '200'))
+
+# Fields a replay may overwrite on an existing order (with overwrite=True); status, builder
+# and timing fields are left alone
+ORDER_PARSED_FIELDS = ('route_name', 'route', 'pick_up_date', 'pick_up_time', 'total_cases', 'items')
+
+
+def replay_order_email(compressed):
+    """
+    Process pool worker: re-parses one archived order email with the current parser.
+
+    :return: The parsed order details, or None if it holds no items.
+    """
+    raw_email = zlib.decompress(compressed)
+    extracted_data = parse_email_content(BytesParser(policy=policy.default).parsebytes(raw_email))
+    return extracted_data if extracted_data['items'] else None
+
+
+def replay_inventory_pdf(compressed):
+    """
+    Process pool worker: re-parses one archived inventory PDF with the current parser.
+    """
+    inventory_data = parse_inventory_pdf(zlib.decompress(compressed))
+    return inventory_data if inventory_data['items'] else None
+
+
+def build_order_upserts(extracted_data, received_at, status, overwrite=False):
+    """
+    Builds the writes that replay one order, matched by message_id.
+
+    Orders missing from the database are inserted with an _id dated when the
+    email arrived; existing orders are left as they are. With overwrite, existing
+    orders also get their parsed fields refreshed, except orders that have been
+    edited since (edited_at is set by the order edit views) and a pick-up date
+    the parser could not read.
+
+    :return: List of UpdateOne operations.
+    """
+    order_document = build_order_document(extracted_data)
+    order_id = object_id_at(received_at)
+    parsed_fields = {field: order_document[field] for field in ORDER_PARSED_FIELDS}
+
+    operations = [UpdateOne(
+        {'message_id': order_document['message_id']},
+        {'$setOnInsert': {**parsed_fields, '_id': order_id, 'transfer_id': str(order_id)[-4:],
+                          'match_key': transfer_match_key(order_id), 'status': status,
+                          'order_submitted': received_at, 'message_id': order_document['message_id']}},
+        upsert=True
+    )]
+    if overwrite:
+        if extracted_data.get('pick_up_date_estimated'):
+            del parsed_fields['pick_up_date']
+        operations.append(UpdateOne(
+            {'message_id': order_document['message_id'], 'edited_at': {'$exists': False}},
+            {'$set': parsed_fields}
+        ))
+    return operations
+
+
+def replay_inventory(client, inventory_data, pdf_sha256, received_at, counts, db_name='mydatabase'):
+    """
+    Saves one re-parsed inventory the way inventory_main saves a new one, dated when its PDF arrived.
+
+    Inventories already saved get their re-parsed items through replace_inventory_items.
+    """
+    inventory_data['pdf_sha256'] = pdf_sha256
+    if save_inventory_to_mongodb(inventory_data, client, object_id_at(received_at), received_at, db_name):
+        counts['upserted'] += 1
+    elif replace_inventory_items(client, inventory_data, db_name):
+        counts['modified'] += 1
+
+
+def replay_archive(client, kind, since=None, until=None, workers=None, batch_size=None, status='Complete',
+                   overwrite=False, db_name='mydatabase'):
+    """
+    Re-parses archived order emails or inventory PDFs with the current parsers and upserts the results.
+
+    Parsing runs across a process pool. Each batch of orders goes back to
+    MongoDB as one unordered bulk_write; inventories are saved one by one, in
+    the snapshots and level series too, and old ones compacted at the end.
+
+    :param kind: ORDER_EMAIL or INVENTORY_PDF.
+    :param since: Only replay content received at or after this datetime.
+    :param until: Only replay content received before this datetime.
+    :param status: Status given to orders the replay inserts rather than updates.
+    :param overwrite: Refresh the parsed fields of orders that already exist (see build_order_upserts).
+    :return: Dict with the replayed, skipped, upserted and modified counts, and for
+             inventories the number of documents compacted.
+    """
+    batch_size = batch_size or REPLAY_BATCH_SIZE
+    if kind == ORDER_EMAIL:
+        worker, collection = replay_order_email, client[db_name]['orders']
+    elif kind == INVENTORY_PDF:
+        worker, collection = replay_inventory_pdf, client[db_name]['inventory']
+    else:
+        raise ValueError(f"Unknown archive kind {kind}")
+
+    counts = {'replayed': 0, 'skipped': 0, 'upserted': 0, 'modified': 0}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        batch = []
+        for file_document in find_archived(client, kind, since, until, db_name):
+            batch.append(file_document)
+            if len(batch) >= batch_size:
+                replay_batch(client, executor, worker, collection, batch, kind, status, overwrite, counts, db_name)
+                batch = []
+        if batch:
+            replay_batch(client, executor, worker, collection, batch, kind, status, overwrite, counts, db_name)
+
+    if kind == INVENTORY_PDF:
+        counts['compacted'] = compact_inventory_documents(client, INVENTORY_FULL_DOCUMENTS, db_name)
+    return counts
+
+
+def replay_batch(client, executor, worker, collection, batch, kind, status, overwrite, counts, db_name):
+    blobs = [read_compressed(client, file_document['_id'], db_name) for file_document in batch]
+
+    operations = []
+    for file_document, parsed in zip(batch, executor.map(worker, blobs)):
+        counts['replayed'] += 1
+        if parsed is None:
+            counts['skipped'] += 1
+            continue
+        received_at = file_document['metadata']['received_at']
+        if kind == ORDER_EMAIL:
+            operations.extend(build_order_upserts(parsed, received_at, status, overwrite))
+        else:
+            replay_inventory(client, parsed, file_document['_id'], received_at, counts, db_name)
+
+    if operations:
+        result = collection.bulk_write(operations, ordered=False)
+        counts['upserted'] += result.upserted_count
+        counts['modified'] += result.modified_count
+    print(f"Replayed {counts['replayed']} archived files so far.")
@@ -0,0 +1,36 @@
+from bson.objectid import ObjectId
+from celery import shared_task
+
+from operations.item_ordering import refresh_catalog_version
+from operations.mongodb_utils import get_client
+from operations.order_pdfs import ORDER_PDF_PROJECTION, render_order_pdf, render_open_order_pdfs, \
+    refresh_mapped_items_version
+from operations.transfers import backfill_match_keys
+
+
+@shared_task
+def render_order_pdf_task(order_id):
+    client = get_client()
+    order = client['mydatabase']['orders'].find_one({'_id': ObjectId(order_id)}, ORDER_PDF_PROJECTION)
+    if order is None:
+        print(f"Order {order_id} not found, no PDF rendered.")
+        return
+    render_order_pdf(client, order)
+
+
+@shared_task
+def render_open_order_pdfs_task():
+    client = get_client()
+    refresh_mapped_items_version(client)
+    return render_open_order_pdfs(client)
+
+
+@shared_task
+def refresh_catalog_version_task():
+    return refresh_catalog_version(get_client())
+
+
+@shared_task
+def key_new_transfers_task():
+    # Orders get their match_key when they are ingested; transfers come from outside the app
+    return backfill_match_keys(get_client(), collections=['transfers'])
@@ -1,3 +1,708 @@
-from django.test import TestCase
+import asyncio
+from datetime import datetime
+from email import message_from_bytes, policy
 
-# Create your tests here.
+import os
+import socket
+
+import fitz
+import numpy as np
+import pandas as pd
+from bson.objectid import ObjectId
+from django.test import SimpleTestCase
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from unittest import mock, skipUnless
+
+from operations.Inventory_Backend import parse_inventory_pdf, parse_inventory_pdfs_parallel, diff_oos_items, \
+    identify_and_upload_oos_items, generate_and_save_inventory_stats, identify_and_upload_oos_items_aggregate, \
+    generate_and_save_inventory_stats_aggregate, ensure_oos_indexes, skip_parsed_pdfs
+from operations import Order_Backend
+from operations.Order_Backend import extract_table_from_html, extract_table_from_html_bs4, \
+    fetch_raw_route_order_emails, insert_orders_into_mongodb
+from operations.imap_utils import search_uids_after, format_uid_set, parse_fetch_response, parse_imap_data, \
+    join_fetch_response, iter_body_parts, get_part_filename, decode_part, idle_wait
+from operations import mongodb_utils
+from operations import item_ordering
+from operations.indexes import find_plan_index
+from operations.order_pagination import get_order_page
+from operations import order_pdfs
+from operations import order_pipeline
+from operations.order_pdfs import ORDER_PDF_TTL, order_pdf_etag, draw_order_pdf, is_fresh_pdf
+from operations.inventory_series import average_depletion, weeks_of_supply, trend_slope
+from operations.inventory_snapshots import index_items, diff_inventory_items, apply_delta
+from operations.raw_archive import get_received_at, object_id_at
+from operations import replay
+from operations.replay import build_order_upserts
+from operations.transfers import transfer_match_key, find_matching_transfer
+
+
+class FakeUidSearchMail:
+    """Answers UID SEARCH the way Gmail does, including for an empty `n:*` range."""
+
+    def __init__(self, uids):
+        self.uids = uids
+
+    def uid(self, command, charset, criteria):
+        low = int(criteria.split()[1].split(':')[0])
+        matches = [uid for uid in self.uids if uid >= low] or self.uids[-1:]
+        return 'OK', [' '.join(str(uid) for uid in matches).encode()]
+
+
+class UidWatermarkTests(SimpleTestCase):
+    def test_returns_only_newer_uids(self):
+        mail = FakeUidSearchMail([101, 102, 105])
+        self.assertEqual(search_uids_after(mail, 101), [102, 105])
+
+    def test_star_range_does_not_repeat_last_message(self):
+        # `UID SEARCH UID 106:*` still matches the newest message (105)
+        mail = FakeUidSearchMail([101, 102, 105])
+        self.assertEqual(search_uids_after(mail, 105), [])
+
+
+class SocketPairMail:
+    """The parts of an IMAP4 session idle_wait uses, over one end of a socket pair."""
+
+    capabilities = ('IMAP4REV1', 'IDLE')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('rb')
+
+    def _new_tag(self):
+        return b'A001'
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self):
+        return self.file.readline()
+
+
+class IdleWaitTests(SimpleTestCase):
+    def test_sees_exists_buffered_behind_another_line(self):
+        client_sock, server_sock = socket.socketpair()
+        self.addCleanup(client_sock.close)
+        self.addCleanup(server_sock.close)
+        # Everything arrives in one read, so EXISTS is already in the buffer when select() would run
+        server_sock.sendall(b'+ idling\r\n* 3 FETCH (FLAGS (\\Seen))\r\n* 5 EXISTS\r\nA001 OK IDLE terminated\r\n')
+
+        self.assertTrue(idle_wait(SocketPairMail(client_sock), timeout=5))
+
+
+class BatchedFetchTests(SimpleTestCase):
+    def test_uid_set_collapses_runs(self):
+        self.assertEqual(format_uid_set([1, 2, 3, 7, 9, 10]), '1:3,7,9:10')
+
+    def test_fetch_response_pairs_literals_with_uids(self):
+        data = [
+            (b'1 (UID 41 BODY[] {5}', b'first'), b')',
+            (b'2 (BODY[] {6}', b'second'), b' UID 42)',
+        ]
+        self.assertEqual(list(parse_fetch_response(data)), [(41, b'first'), (42, b'second')])
+
+
+class FakeMailbox:
+    """Serves UID FETCH requests from a dict of raw messages and records what was asked for."""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.fetches = []
+
+    def uid(self, command, message_set, message_parts):
+        self.fetches.append((message_set, message_parts))
+        data = []
+        for part in message_set.split(','):
+            low, _, high = part.partition(':')
+            for uid in range(int(low), int(high or low) + 1):
+                raw = self.messages[uid]
+                if 'HEADER.FIELDS' in message_parts:
+                    raw = raw.split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n'
+                data.append((f'{uid} (UID {uid} BODY[] {{{len(raw)}}}'.encode(), raw))
+                data.append(b')')
+        return 'OK', data
+
+
+def make_raw_email(subject, body='Route Number: RTC000003'):
+    return f'Subject: {subject}\r\nMessage-ID: <{abs(hash(subject))}@example.com>\r\n\r\n{body}'.encode()
+
+
+class HeaderFirstFetchTests(SimpleTestCase):
+    def test_only_route_orders_are_downloaded_in_full(self):
+        mail = FakeMailbox({
+            1: make_raw_email('Route Order for RTC000003'),
+            2: make_raw_email('Weekly newsletter'),
+            3: make_raw_email('Fwd: Route Order for RTC000004'),
+        })
+
+        orders = list(fetch_raw_route_order_emails(mail, [1, 2, 3]))
+
+        self.assertEqual([uid for uid, _ in orders], [1, 3])
+        self.assertEqual(message_from_bytes(orders[1][1], policy=policy.default)['Subject'],
+                         'Fwd: Route Order for RTC000004')
+        self.assertEqual(mail.fetches[-1][0], '1,3')
+
+
+ORDER_TABLE_CORPUS = [
+    # Typical route order: header row, then item rows
+    '<table><tr><th>Item</th><th>Description</th><th>Qty</th></tr>'
+    '<tr><td>10234</td><td>Sparkling Water 12pk</td><td>4</td></tr>'
+    '<tr><td>10235</td><td>Still Water 24pk</td><td> 12 </td></tr></table>',
+    # Layout table wrapping the item table, as produced by most mail clients
+    '<table width="100%"><tr><td><table><tr><td>No</td><td>Desc</td><td>Qty</td></tr>'
+    '<tr><td><span>555</span></td><td><p>Cola &amp; Lime</p></td><td align="right">7</td><td>x</td></tr>'
+    '</table></td></tr><tr><td>footer</td></tr></table>',
+    # Forwarded copy with quoting, comments and entities
+    '<div>---------- Forwarded message ---------</div><blockquote><table>'
+    '<tr><td>Item</td><td>Desc</td><td>Qty</td></tr><!-- generated -->'
+    '<tr><td>&#49;&#50;3</td><td>Caf&eacute; Latte&nbsp;</td><td>2</td></tr>'
+    '<tr><td>124</td><td>Tea &#150; Green</td><td>two</td></tr></table></blockquote>',
+    # Unclosed cells and rows, and stray end tags
+    '<table><tr><td>a<td>b<td>c<tr><td>900<td>Juice<td>3</table></td></tr>',
+    # Void elements, self-closing tags and hidden text
+    '<table><tr><td>h</td></tr><tr><td>77<br></td><td>Chips<script>x</script><br/></td>'
+    '<td><style>p{}</style>5</td></tr><tr><td/><td>Empty</td><td>1</td></tr></table>',
+    # The br / br-slash / end-br sequence that reopens a br element in BeautifulSoup
+    '<br><br/><table><tr></br><table><tr><td>9</td><td>N</td><td>3</td></tr></table>',
+    # No tables at all
+    '<p>Route Name: Test</p>',
+]
+
+
+class OrderTableExtractorParityTests(SimpleTestCase):
+    def test_stream_extractor_matches_beautifulsoup(self):
+        for html_body in ORDER_TABLE_CORPUS:
+            with self.subTest(html_body=html_body[:60]):
+                self.assertEqual(
+                    extract_table_from_html(html_body, {'items': []}),
+                    extract_table_from_html_bs4(html_body, {'items': []}),
+                )
+
+    def test_extracts_item_rows(self):
+        extracted_data = extract_table_from_html(ORDER_TABLE_CORPUS[0], {'items': []})
+        self.assertEqual(extracted_data['items'], [
+            {'ItemNumber': '10234', 'ItemDescription': 'Sparkling Water 12pk', 'Quantity': 4},
+            {'ItemNumber': '10235', 'ItemDescription': 'Still Water 24pk', 'Quantity': 12},
+        ])
+
+
+class FakeInsertCollection:
+    """Fails the given writeErrors the way an unordered insert_many does and inserts the rest."""
+
+    def __init__(self, write_errors=()):
+        self.write_errors = list(write_errors)
+        self.inserted = []
+
+    def insert_many(self, documents, ordered=True):
+        failed = {write_error['index'] for write_error in self.write_errors}
+        self.inserted = [document for index, document in enumerate(documents) if index not in failed]
+        if self.write_errors:
+            raise BulkWriteError({'writeErrors': self.write_errors, 'nInserted': len(self.inserted)})
+        return mock.Mock(inserted_ids=[document['_id'] for document in documents])
+
+
+class OrderInsertTests(SimpleTestCase):
+    def setUp(self):
+        self.orders = [{'_id': ObjectId(), 'route': str(route), 'message_id': f'<order-{route}@example.com>'}
+                       for route in range(3)]
+
+    def insert(self, collection):
+        return insert_orders_into_mongodb(self.orders, {'mydatabase': {'orders': collection}})
+
+    def test_failed_documents_are_reported_and_the_rest_inserted(self):
+        collection = FakeInsertCollection([{'index': 1, 'code': 121, 'errmsg': 'Document failed validation'}])
+
+        self.assertEqual(self.insert(collection), [(self.orders[1], 'Document failed validation')])
+        self.assertEqual(collection.inserted, [self.orders[0], self.orders[2]])
+
+    def test_already_ingested_emails_are_not_failures(self):
+        collection = FakeInsertCollection([
+            {'index': 0, 'code': 11000, 'errmsg': 'E11000 duplicate key error collection: orders index: message_id_1'},
+            {'index': 2, 'code': 121, 'errmsg': 'Document failed validation'},
+        ])
+
+        self.assertEqual(self.insert(collection), [(self.orders[2], 'Document failed validation')])
+        self.assertEqual(collection.inserted, [self.orders[1]])
+
+    def test_clean_batch_has_no_failures(self):
+        collection = FakeInsertCollection()
+
+        self.assertEqual(self.insert(collection), [])
+        self.assertEqual(collection.inserted, self.orders)
+
+    def test_failed_order_holds_the_uid_watermark(self):
+        collection = FakeInsertCollection([{'index': 1, 'code': 121, 'errmsg': 'Document failed validation'}])
+        orders = iter(self.orders)
+
+        with mock.patch.object(Order_Backend, 'select_mailbox', return_value=1), \
+                mock.patch.object(Order_Backend, 'get_uid_watermark', return_value=(1, 9)), \
+                mock.patch.object(Order_Backend, 'search_new_email_uids', return_value=[10, 11, 12, 13, 14]), \
+                mock.patch.object(Order_Backend, 'fetch_raw_route_order_emails',
+                                  return_value=[(11, b''), (12, b''), (13, b'')]), \
+                mock.patch.object(Order_Backend, 'parse_email_content', return_value={'message_id': None}), \
+                mock.patch.object(Order_Backend, 'archive_raw'), \
+                mock.patch.object(Order_Backend, 'build_order_document', side_effect=lambda data: next(orders)), \
+                mock.patch.object(Order_Backend, 'save_uid_watermark') as save_uid_watermark:
+            Order_Backend.process_new_order_emails(None, {'mydatabase': {'orders': collection}})
+
+        save_uid_watermark.assert_called_once_with({'mydatabase': {'orders': collection}}, 1, 11, 'mydatabase')
+
+
+class FakeAsyncCollection:
+    """The Motor collection calls the order pipeline makes, failing inserts of the given _ids."""
+
+    def __init__(self, failing_ids=(), status=None):
+        self.failing_ids = set(failing_ids)
+        self.status = status
+        self.inserted = []
+        self.updates = []
+
+    async def insert_many(self, documents, ordered=True):
+        write_errors = [{'index': index, 'code': 121, 'errmsg': 'Document failed validation'}
+                        for index, document in enumerate(documents) if document['_id'] in self.failing_ids]
+        inserted = [document for document in documents if document['_id'] not in self.failing_ids]
+        self.inserted += inserted
+        if write_errors:
+            raise BulkWriteError({'writeErrors': write_errors, 'nInserted': len(inserted)})
+        return mock.Mock(inserted_ids=[document['_id'] for document in documents])
+
+    async def find_one(self, query):
+        return self.status
+
+    async def update_one(self, query, update, upsert=False):
+        self.updates.append(update)
+        return mock.Mock(matched_count=1)
+
+
+class OrderPipelineWatermarkTests(SimpleTestCase):
+    order_uids = [11, 12, 13]
+
+    def run_pipeline(self, failing_uids=(), fetched_uids=order_uids):
+        document_ids = {uid: ObjectId() for uid in self.order_uids}
+        orders = FakeAsyncCollection(failing_ids=[document_ids[uid] for uid in failing_uids])
+        status = FakeAsyncCollection(status={'variable': 'last_parsed', 'value': 9, 'uidvalidity': 1})
+        db = {'orders': orders, 'status': status}
+
+        async def fetch_stage(mail, order_uids, raw_queue):
+            for uid in fetched_uids:
+                await raw_queue.put((uid, b''))
+
+        async def parse_stage(db, raw_queue, parsed_queue):
+            while (item := await raw_queue.get()) is not order_pipeline._DONE:
+                await parsed_queue.put((item[0], {'_id': document_ids[item[0]]}))
+
+        with mock.patch.object(order_pipeline, 'select_mailbox', return_value=1), \
+                mock.patch.object(order_pipeline, 'search_new_email_uids', return_value=[10, 11, 12, 13, 14]), \
+                mock.patch.object(order_pipeline, 'find_route_order_uids', return_value=self.order_uids), \
+                mock.patch.object(order_pipeline, 'fetch_stage', fetch_stage), \
+                mock.patch.object(order_pipeline, 'parse_stage', parse_stage):
+            asyncio.run(order_pipeline.process_new_order_emails(None, db))
+        return [update['$max']['value'] for update in status.updates]
+
+    def test_watermark_moves_past_every_uid_once_all_orders_are_written(self):
+        self.assertEqual(self.run_pipeline()[-1], 14)
+
+    def test_watermark_stays_below_a_failed_insert(self):
+        watermarks = self.run_pipeline(failing_uids=[12])
+        self.assertEqual(max(watermarks), 11)
+
+    def test_watermark_stays_below_an_order_that_was_never_parsed(self):
+        watermarks = self.run_pipeline(fetched_uids=[13, 11])
+        self.assertEqual(max(watermarks), 11)
+
+
+class RawArchiveTests(SimpleTestCase):
+    def test_received_at_is_naive_utc(self):
+        msg = message_from_bytes(b'Date: Tue, 07 May 2024 22:15:00 -0700\r\n\r\n', policy=policy.default)
+        self.assertEqual(get_received_at(msg), datetime(2024, 5, 8, 5, 15))
+
+    def test_backfilled_ids_sort_by_arrival(self):
+        older, newer = object_id_at(datetime(2024, 5, 8, 5, 15)), object_id_at(datetime(2024, 5, 9))
+        self.assertEqual(older.generation_time.replace(tzinfo=None), datetime(2024, 5, 8, 5, 15))
+        self.assertLess(older, newer)
+
+
+def make_inventory_pdf(*pages):
+    doc = fitz.open()
+    for lines in pages:
+        doc.new_page().insert_text((50, 50), '\n'.join(lines), fontsize=9)
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+
+class InventoryPdfParserTests(SimpleTestCase):
+    def test_quantity_on_next_page_belongs_to_previous_item(self):
+        pdf_bytes = make_inventory_pdf(
+            ['Inventory Count', '101 - Cola 12pk', 'Case 4', '102 - Tea Green'],
+            ['Case 7', '103 - Juice Orange', 'Each 3', '104 - Water 24pk'],
+        )
+        self.assertEqual(parse_inventory_pdf(pdf_bytes)['items'], [
+            {'ItemNumber': 101, 'ItemName': 'Cola 12pk', 'Cases': '4', 'Eaches': None},
+            {'ItemNumber': 102, 'ItemName': 'Tea Green', 'Cases': '7', 'Eaches': None},
+            {'ItemNumber': 104, 'ItemName': 'Water 24pk', 'Cases': None, 'Eaches': None},
+        ])
+
+    def test_parallel_parse_matches_serial(self):
+        pdfs = [
+            make_inventory_pdf(['101 - Cola 12pk'], ['Case 4', '102 - Tea Green'], ['Each 1', '103 - Juice']),
+            make_inventory_pdf(['201 - Water 24pk', 'Case 9']),
+        ]
+        self.assertEqual(parse_inventory_pdfs_parallel(pdfs, workers=2, pages_per_task=1),
+                         [parse_inventory_pdf(pdf_bytes) for pdf_bytes in pdfs])
+
+
+class FakeInventoryCollection:
+    def __init__(self, saved_hashes):
+        self.saved_hashes = set(saved_hashes)
+
+    def find_one(self, query, projection=None):
+        return {'_id': ObjectId()} if query['pdf_sha256'] in self.saved_hashes else None
+
+
+class SkipParsedPdfTests(SimpleTestCase):
+    def test_identical_pdfs_are_parsed_once(self):
+        client = {'mydatabase': {'inventory': FakeInventoryCollection(['saved'])}}
+        attachments = [('saved', b'count 1'), ('new', b'count 2'), ('new', b'count 2 forwarded'),
+                       ('other', b'count 3')]
+
+        self.assertEqual(list(skip_parsed_pdfs(attachments, client)), [('new', b'count 2'), ('other', b'count 3')])
+
+
+class BodyStructureTests(SimpleTestCase):
+    # Gmail-style response: text alternative, inline logo, and a PDF whose filename arrives as a literal
+    FETCH_DATA = [
+        (b'1 (UID 42 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "7BIT" 12 1 NIL NIL NIL)'
+         b'("TEXT" "HTML" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 40 1 NIL NIL NIL) "ALTERNATIVE" '
+         b'("BOUNDARY" "b1") NIL NIL)("IMAGE" "PNG" ("NAME" "logo.png") "<logo>" NIL "BASE64" 5000 NIL '
+         b'("INLINE" ("FILENAME" "logo.png")) NIL)("APPLICATION" "PDF" ("NAME" "x.pdf") NIL NIL "BASE64" 1200 '
+         b'NIL ("ATTACHMENT" ("FILENAME" {13}', b'count-may.pdf'),
+        (b')) NIL) "MIXED" ("BOUNDARY" "b0") NIL NIL) BODY[HEADER.FIELDS (DATE)] {39}',
+         b'Date: Tue, 07 May 2024 22:15:00 -0700\r\n'),
+        b')',
+    ]
+
+    def test_parses_fetch_response_with_literals(self):
+        sequence_number, attributes = parse_imap_data(join_fetch_response(self.FETCH_DATA))
+        self.assertEqual(sequence_number, '1')
+        self.assertEqual(attributes[:2], ['UID', '42'])
+        self.assertEqual(attributes[4], 'BODY[HEADER.FIELDS (DATE)]')
+        self.assertTrue(attributes[5].startswith('Date: Tue, 07 May 2024'))
+
+        parts = dict(iter_body_parts(attributes[3]))
+        self.assertEqual(list(parts), ['1.1', '1.2', '2', '3'])
+        self.assertEqual(get_part_filename(parts['3']), 'count-may.pdf')
+        self.assertEqual(get_part_filename(parts['2']), 'logo.png')
+
+    def test_numbers_parts_inside_attached_messages(self):
+        bodystructure = parse_imap_data(
+            b'(("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1)("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 900 '
+            b'(NIL "Fwd" NIL NIL NIL NIL NIL NIL NIL NIL) (("TEXT" "PLAIN" NIL NIL NIL "7BIT" 5 1)'
+            b'("APPLICATION" "PDF" ("NAME" "=?utf-8?q?Z=C3=A4hlung.pdf?=") NIL NIL "BASE64" 80) "MIXED") 30) "MIXED")'
+        )[0]
+        parts = dict(iter_body_parts(bodystructure))
+        self.assertEqual(list(parts), ['1', '2', '2.1', '2.2'])
+        self.assertEqual(get_part_filename(parts['2.2']), 'Z\u00e4hlung.pdf')
+
+    def test_decodes_transfer_encoding(self):
+        self.assertEqual(decode_part(b'JVBERi0x\r\nLjQK', 'BASE64'), b'%PDF-1.4\n')
+        self.assertEqual(decode_part(b'caf=C3=A9', 'QUOTED-PRINTABLE'), 'caf\u00e9'.encode())
+
+
+class OosDiffTests(SimpleTestCase):
+    def test_only_changes_are_written(self):
+        current = [
+            {'_id': 1, 'ItemNumber': '100', 'ItemDescription': 'Cola'},
+            {'_id': 2, 'ItemNumber': '200', 'ItemDescription': 'Tea'},
+            {'_id': 3, 'ItemNumber': '200', 'ItemDescription': 'Tea'},
+            {'_id': 4, 'ItemNumber': '300', 'ItemDescription': 'Juice'},
+        ]
+        changes = diff_oos_items({'100': 'Cola', '300': 'Orange Juice', '400': 'Water'}, current)
+
+        self.assertEqual({key: changes[key] for key in ('added', 'updated', 'removed')},
+                         {'added': 1, 'updated': 1, 'removed': 1})
+        self.assertEqual(
+            [(type(operation).__name__, operation._filter) for operation in changes['operations']],
+            [('DeleteOne', {'_id': 2}), ('DeleteOne', {'_id': 3}),
+             ('UpdateOne', {'_id': 4}), ('UpdateOne', {'ItemNumber': '400'})],
+        )
+
+
+# The aggregation mode uses $merge and $lookup with let, which only a real server runs
+MONGO_TEST_URI = os.getenv('MONGO_TEST_URI')
+
+
+@skipUnless(MONGO_TEST_URI, 'MONGO_TEST_URI is not set')
+class InventoryAggregateModeTests(SimpleTestCase):
+    python_db = 'test_inventory_python_mode'
+    aggregate_db = 'test_inventory_aggregate_mode'
+
+    def setUp(self):
+        self.client = MongoClient(MONGO_TEST_URI, serverSelectionTimeoutMS=5000)
+        for db_name in (self.python_db, self.aggregate_db):
+            self.client.drop_database(db_name)
+            db = self.client[db_name]
+            db['items'].insert_many([
+                {'ItemNumber': '101', 'ItemDescription': 'Water'},
+                {'ItemNumber': '102.0', 'ItemDescription': 'Cola'},
+                {'ItemNumber': '103'},
+            ])
+            db['inventory'].insert_one({'items': [
+                {'ItemNumber': '101', 'Cases': '5'},
+                {'ItemNumber': '104', 'Cases': '3'},
+                {'ItemNumber': '105', 'Cases': '2.5'},
+                {'ItemNumber': '106', 'Cases': 'x'},
+            ]})
+        ensure_oos_indexes(self.client, self.aggregate_db)
+
+    def tearDown(self):
+        for db_name in (self.python_db, self.aggregate_db):
+            self.client.drop_database(db_name)
+        self.client.close()
+
+    def oos_items(self, db_name):
+        documents = self.client[db_name]['oos_items'].find({}, {'_id': 0, 'ItemNumber': 1, 'ItemDescription': 1})
+        return sorted((document['ItemNumber'], document['ItemDescription']) for document in documents)
+
+    def test_aggregate_mode_matches_python_mode(self):
+        identify_and_upload_oos_items(self.client, self.python_db)
+        generate_and_save_inventory_stats(self.client, self.python_db)
+        self.assertIsNotNone(identify_and_upload_oos_items_aggregate(self.client, self.aggregate_db))
+        generate_and_save_inventory_stats_aggregate(self.client, self.aggregate_db)
+
+        self.assertEqual(self.oos_items(self.python_db), [('102', 'Cola'), ('103', '')])
+        self.assertEqual(self.oos_items(self.aggregate_db), self.oos_items(self.python_db))
+        for db_name in (self.python_db, self.aggregate_db):
+            self.assertEqual(list(self.client[db_name]['inventory_stats'].find({}, {'_id': 0})),
+                             [{'total_inventory': 8, 'num_oos_items': 2}])
+
+    def test_aggregate_mode_removes_items_back_in_stock(self):
+        identify_and_upload_oos_items_aggregate(self.client, self.aggregate_db)
+        self.client[self.aggregate_db]['inventory'].insert_one(
+            {'items': [{'ItemNumber': '101', 'Cases': '4'}, {'ItemNumber': '102.0', 'Cases': '1'}]})
+
+        self.assertEqual(identify_and_upload_oos_items_aggregate(self.client, self.aggregate_db), {'removed': 1})
+        self.assertEqual(self.oos_items(self.aggregate_db), [('103', '')])
+
+
+class QueryPlanTests(SimpleTestCase):
+    def test_finds_index_under_fetch_and_sort(self):
+        plan = {'stage': 'SORT', 'inputStage': {'stage': 'FETCH', 'inputStage': {
+            'stage': 'IXSCAN', 'indexName': 'status_id', 'keyPattern': {'status': 1, '_id': -1}}}}
+        self.assertEqual(find_plan_index(plan), 'status_id')
+
+    def test_collection_scan(self):
+        plan = {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN', 'direction': 'forward'}}
+        self.assertEqual(find_plan_index(plan), 'COLLSCAN')
+
+
+class FakeOrdersCollection:
+    """Supports the _id range, sort and limit calls that keyset pagination makes."""
+
+    def __init__(self, orders):
+        self.orders = orders
+
+    def find(self, query, projection):
+        bounds = query.get('_id', {})
+        self.matches = [order for order in self.orders
+                        if ('$lt' not in bounds or order['_id'] < bounds['$lt'])
+                        and ('$gt' not in bounds or order['_id'] > bounds['$gt'])]
+        return self
+
+    def sort(self, key, direction):
+        self.matches.sort(key=lambda order: order[key], reverse=direction == -1)
+        return self
+
+    def limit(self, count):
+        return [dict(order) for order in self.matches[:count]]
+
+
+class OrderPaginationTests(SimpleTestCase):
+    def test_pages_forward_and_back(self):
+        ids = sorted(ObjectId() for _ in range(7))
+        collection = FakeOrdersCollection([{'_id': order_id} for order_id in ids])
+
+        first = get_order_page(collection, {}, page_size=3)
+        self.assertEqual([order['_id'] for order in first], ids[:-4:-1])
+        self.assertFalse(first.has_previous)
+
+        last = get_order_page(collection, {}, after=get_order_page(collection, {}, after=first.next_cursor,
+                                                                   page_size=3).next_cursor, page_size=3)
+        self.assertEqual([order['_id'] for order in last], ids[:1])
+        self.assertFalse(last.has_next)
+
+        back = get_order_page(collection, {}, before=last.previous_cursor, page_size=3)
+        self.assertEqual([order['_id'] for order in back], ids[3:0:-1])
+        self.assertTrue(back.has_previous)
+
+    def test_bad_cursor_shows_first_page(self):
+        collection = FakeOrdersCollection([{'_id': ObjectId()}])
+        self.assertEqual(len(get_order_page(collection, {}, after='not-an-id')), 1)
+
+
+class TransferMatchKeyTests(SimpleTestCase):
+    def test_order_and_transfer_keys_agree(self):
+        order_id = ObjectId('65f1c2a9e4b0a1b2c3d4e5f6')
+        self.assertEqual(transfer_match_key(order_id), 'e5f6')
+        self.assertEqual(transfer_match_key(' TR-1042E5F6 '), transfer_match_key(order_id))
+
+    def test_missing_transfer_is_one_equality_lookup(self):
+        transfers = mock.Mock(find_one=mock.Mock(return_value=None))
+        order = {'_id': ObjectId('65f1c2a9e4b0a1b2c3d4e5f6')}
+
+        self.assertIsNone(find_matching_transfer({'mydatabase': {'transfers': transfers}}, order))
+        transfers.find_one.assert_called_once_with({'match_key': 'e5f6'})
+
+
+class PooledClientTests(SimpleTestCase):
+    def tearDown(self):
+        mongodb_utils._client = mongodb_utils._client_pid = None
+
+    @mock.patch.object(mongodb_utils, 'MongoClient')
+    def test_one_client_per_process(self, mongo_client):
+        mongo_client.side_effect = lambda *args, **kwargs: mock.Mock()
+        with mock.patch('os.getpid', return_value=100):
+            parent = mongodb_utils.get_client()
+            self.assertIs(mongodb_utils.get_client(), parent)
+        with mock.patch('os.getpid', return_value=101):
+            child = mongodb_utils.get_client()
+
+        self.assertIsNot(child, parent)
+        parent.close.assert_not_called()
+        self.assertEqual(mongo_client.call_args.kwargs['maxPoolSize'], mongodb_utils.MONGO_MAX_POOL_SIZE)
+
+
+class OrderPdfTests(SimpleTestCase):
+    order = {'route': 'RTC000003', 'pick_up_date': datetime(2024, 5, 1), 'transfer_id': 'ab12',
+             'builder_name': 'Gino', 'status': 'Pending',
+             'items': [{'ItemNumber': '1', 'ItemDescription': 'Cola', 'Quantity': 5}]}
+    versions = {'oos_version': 1, 'mapped_items_version': 0, 'catalog_version': 3}
+
+    def test_etag_follows_drawn_data_only(self):
+        etag = order_pdf_etag(self.order, self.versions, now=0)
+        self.assertEqual(order_pdf_etag({**self.order, 'status': 'Complete'}, self.versions, now=0), etag)
+        self.assertNotEqual(order_pdf_etag({**self.order, 'builder_name': 'Ramon'}, self.versions, now=0), etag)
+        self.assertNotEqual(order_pdf_etag(self.order, {**self.versions, 'oos_version': 2}, now=0), etag)
+
+    def test_etag_and_stored_pdf_expire_after_ttl(self):
+        self.assertNotEqual(order_pdf_etag(self.order, self.versions, now=0),
+                            order_pdf_etag(self.order, self.versions, now=ORDER_PDF_TTL))
+
+        etag = order_pdf_etag(self.order, self.versions)
+        self.assertTrue(is_fresh_pdf({'etag': etag, 'rendered_at': datetime.now()}, etag))
+        self.assertFalse(is_fresh_pdf({'etag': etag, 'rendered_at': datetime(2000, 1, 1)}, etag))
+
+    def test_draws_pdf(self):
+        pdf = draw_order_pdf(self.order, self.order['items'], {'1'}, {'1': 'A1'}, {'1': 'PG10'})
+        self.assertTrue(pdf.startswith(b'%PDF-'))
+
+    def test_draws_ship_to_order_without_typed_items_or_date(self):
+        order = {**self.order, 'pick_up_date': None}
+        pdf = draw_order_pdf(order, order['items'], set(), {}, {})
+        self.assertTrue(pdf.startswith(b'%PDF-'))
+
+    def test_one_failing_order_does_not_stop_the_others(self):
+        orders = [{**self.order, '_id': ObjectId()} for _ in range(3)]
+        client = {'mydatabase': {'orders': mock.Mock(find=mock.Mock(return_value=orders)),
+                                 'order_pdfs': mock.Mock(find=mock.Mock(return_value=[]))}}
+        rendered = []
+
+        def render_order_pdf(client, order, versions, pick_sheet_data, db_name):
+            if order is orders[0]:
+                raise ZeroDivisionError('division by zero')
+            rendered.append(order)
+
+        with mock.patch.object(order_pdfs, 'get_data_versions', return_value=self.versions), \
+                mock.patch.object(order_pdfs, 'load_pick_sheet_data', return_value=(set(), {}, {})), \
+                mock.patch.object(order_pdfs, 'render_order_pdf', side_effect=render_order_pdf):
+            self.assertEqual(order_pdfs.render_open_order_pdfs(client), 2)
+        self.assertEqual(rendered, orders[1:])
+
+
+class ItemOrderingCacheTests(SimpleTestCase):
+    def setUp(self):
+        item_ordering._cache.clear()
+
+    def test_cache_keyed_on_catalog_version(self):
+        with mock.patch.object(item_ordering, 'get_catalog_version', side_effect=[1, 1, 2]), \
+                mock.patch.object(item_ordering, 'fetch_item_ordering', side_effect=[{'1': 1}, {'1': 2}]) as fetch:
+            self.assertEqual(item_ordering.get_item_ordering(None), {'1': 1})
+            self.assertEqual(item_ordering.get_item_ordering(None), {'1': 1})
+            self.assertEqual(item_ordering.get_item_ordering(None), {'1': 2})
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_failed_load_is_not_cached(self):
+        with mock.patch.object(item_ordering, 'get_catalog_version', return_value=1), \
+                mock.patch.object(item_ordering, 'fetch_item_ordering', side_effect=[None, {'1': 1}]):
+            self.assertEqual(item_ordering.get_item_ordering(None), {})
+            self.assertEqual(item_ordering.get_item_ordering(None), {'1': 1})
+
+
+class ReplayOrderTests(SimpleTestCase):
+    extracted_data = {'route_name': 'Downtown', 'route_number': 'RTC000003', 'pick_up_date': datetime(2024, 5, 1),
+                      'pick_up_date_estimated': False, 'message_id': '<a@b>',
+                      'items': [{'ItemNumber': '1', 'ItemDescription': 'Cola', 'Quantity': 5}]}
+
+    def test_existing_orders_are_left_alone_by_default(self):
+        [insert] = build_order_upserts(self.extracted_data, datetime(2024, 4, 30), 'Complete')
+        self.assertEqual(list(insert._doc), ['$setOnInsert'])
+        self.assertTrue(insert._upsert)
+
+    def test_overwrite_skips_edited_orders_and_estimated_dates(self):
+        _, overwrite = build_order_upserts({**self.extracted_data, 'pick_up_date_estimated': True},
+                                           datetime(2024, 4, 30), 'Complete', overwrite=True)
+        self.assertEqual(overwrite._filter, {'message_id': '<a@b>', 'edited_at': {'$exists': False}})
+        self.assertNotIn('pick_up_date', overwrite._doc['$set'])
+        self.assertEqual(overwrite._doc['$set']['items'], self.extracted_data['items'])
+
+
+class ReplayInventoryTests(SimpleTestCase):
+    def replay(self, inserted_id, replaced):
+        counts = {'upserted': 0, 'modified': 0}
+        with mock.patch.object(replay, 'save_inventory_to_mongodb', return_value=inserted_id) as save, \
+                mock.patch.object(replay, 'replace_inventory_items', return_value=replaced):
+            replay.replay_inventory(None, {'items': [{'ItemNumber': '1', 'Cases': '5'}]}, 'abc',
+                                    datetime(2024, 4, 30), counts)
+        # Dated to when the PDF arrived, in the document _id and the snapshot
+        _, _, inventory_id, taken_at, _ = save.call_args.args
+        self.assertEqual((inventory_id.generation_time.replace(tzinfo=None), taken_at), (datetime(2024, 4, 30),) * 2)
+        return counts
+
+    def test_missing_inventory_goes_through_the_save_path(self):
+        self.assertEqual(self.replay(ObjectId(), replaced=False), {'upserted': 1, 'modified': 0})
+
+    def test_saved_inventory_gets_its_items_replaced(self):
+        self.assertEqual(self.replay(None, replaced=True), {'upserted': 0, 'modified': 1})
+
+
+class InventorySnapshotDeltaTests(SimpleTestCase):
+    def test_delta_round_trip(self):
+        before = index_items([
+            {'ItemNumber': 101, 'ItemName': 'Cola 12pk', 'Cases': '4', 'Eaches': None},
+            {'ItemNumber': 102, 'ItemName': 'Tea Green', 'Cases': '7', 'Eaches': None},
+            {'ItemNumber': 103, 'ItemName': 'Juice', 'Cases': '1', 'Eaches': None},
+        ])
+        after = index_items([
+            {'ItemNumber': 101, 'ItemName': 'Cola 12pk', 'Cases': '4', 'Eaches': None},
+            {'ItemNumber': 102, 'ItemName': 'Tea Green', 'Cases': '2', 'Eaches': None},
+            {'ItemNumber': 104, 'ItemName': 'Water', 'Cases': '9', 'Eaches': None},
+        ])
+
+        delta = diff_inventory_items(before, after)
+
+        self.assertEqual([item['ItemNumber'] for item in delta['upserts']], [102, 104])
+        self.assertEqual(delta['removals'], [103])
+        self.assertEqual(apply_delta(dict(before), delta), after)
+
+
+class InventorySeriesTests(SimpleTestCase):
+    def test_run_rates_for_all_items_at_once(self):
+        levels = pd.DataFrame({
+            101: [70, 60, 50, 40, 30, 20, 10],
+            102: [5, 5, np.nan, 5, 5, 5, 5],
+            104: [10, 8, 30, 28, 26, 24, 22],
+        }, index=pd.date_range('2024-01-07', periods=7, freq='W'))
+
+        self.assertEqual(average_depletion(levels).loc[101], 10)
+        self.assertEqual(weeks_of_supply(levels).tolist(), [1.0, np.inf, np.inf])
+        np.testing.assert_allclose(trend_slope(levels).to_numpy(), [-10.0, 0.0, 10 / 7], atol=1e-9)
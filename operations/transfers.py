@@ -0,0 +1,53 @@
+from pymongo import UpdateOne
+
+# Transfers reference an order by the last characters of its _id
+TRANSFER_SUFFIX_LENGTH = 4
+
+# Field each collection's match_key is derived from
+MATCH_KEY_REFERENCES = {'orders': '_id', 'transfers': 'transfer_id'}
+
+
+def transfer_match_key(reference):
+    """
+    Normalizes an order _id or transfer_id to the suffix that links the two.
+    """
+    return str(reference).strip().lower()[-TRANSFER_SUFFIX_LENGTH:]
+
+
+def find_matching_transfer(client, order, db_name='mydatabase', transfers_collection='transfers'):
+    """
+    Finds the transfer for an order by its indexed match_key.
+
+    Transfers are written by the transfer system without a match_key; the
+    key_new_transfers task sets it on them every few minutes (see backfill_match_keys),
+    so a transfer that arrived since then is not found yet.
+    """
+    match_key = order.get('match_key') or transfer_match_key(order['_id'])
+    return client[db_name][transfers_collection].find_one({'match_key': match_key})
+
+
+def backfill_match_keys(client, db_name='mydatabase', batch_size=1000, collections=None):
+    """
+    Sets match_key on the orders and transfers that do not have one yet.
+
+    :param collections: Names from MATCH_KEY_REFERENCES to backfill, all of them by default.
+    :return: Dict of collection -> number of documents updated.
+    """
+    db = client[db_name]
+    updated = {}
+    for collection_name in collections or MATCH_KEY_REFERENCES:
+        reference_field = MATCH_KEY_REFERENCES[collection_name]
+        collection = db[collection_name]
+        cursor = collection.find({'match_key': {'$exists': False}, reference_field: {'$ne': None}},
+                                 {reference_field: 1})
+        operations = []
+        updated[collection_name] = 0
+        for document in cursor:
+            operations.append(UpdateOne({'_id': document['_id']},
+                                        {'$set': {'match_key': transfer_match_key(document[reference_field])}}))
+            if len(operations) >= batch_size:
+                updated[collection_name] += collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        if operations:
+            updated[collection_name] += collection.bulk_write(operations, ordered=False).modified_count
+    return updated
@@ -47,6 +47,7 @@ urlpatterns = [
     path('api/trigger-process-inventory/', views.trigger_process_inventory, name='trigger_process_inventory'),
     path('api/update-builder/<str:order_id>/', views.update_builder, name='update_builder'),
     path('api/delete-item/<str:item_id>/', views.update_builder, name='delete_item'),
+    path('api/mongo-pool-stats/', views.mongo_pool_stats, name='mongo_pool_stats'),
 
     # RSR Orders
     path('warehouse/order/rsr/view/', views.rsr_orders_view, name='rsr_orders_view'),